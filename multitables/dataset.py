@@ -8,6 +8,8 @@ try:
 except ImportError:
     import collections as collections_abc
 
+import numpy as np
+
 from . import stage
 from . import numpy_utils
 from .dataset_ops import \
@@ -43,7 +45,14 @@ class Dataset(DatasetBase):
         :param shape: The partial shape, can be an integer or tuple.
         :return: The completed shape.
         """
-        if not isinstance(shape, (collections_abc.Iterable, collections_abc.Sequence)):
+        if isinstance(shape, tuple) and len(shape) == len(self.shape) and \
+                all(s is not None and s != -1 for s in shape):
+            # A complete shape, such as the shape of an example block, needs no filling.
+            return shape
+        elif isinstance(shape, int):
+            # Most stages are sized by a number of rows alone, which avoids the abstract type checks below.
+            shape = [shape]
+        elif not isinstance(shape, (collections_abc.Iterable, collections_abc.Sequence)):
             shape = [shape]
         shape = list(shape)
         if len(shape) < len(self.shape):
@@ -53,25 +62,44 @@ class Dataset(DatasetBase):
                 shape[i] = self.shape[i]
         return shape
 
-    def create_stage(self, shape):
+    def _stage_nbytes(self, shape, dtype=None):
+        """
+        Calculate the size in bytes of a stage that can host requests with a size equal to the given shape.
+
+        :param shape: A shape that specifies the size of the stage. See create_stage.
+        :param dtype: The datatype of the results the stage should hold, if it differs from that of this dataset.
+        :return: The size of the stage in bytes.
+        """
+        if dtype is None:
+            dtype = self.dtype
+        else:
+            dtype = np.dtype(dtype)
+        return numpy_utils._calc_nbytes(dtype, self._fill_shape(shape))
+
+    def create_stage(self, shape, prefault=False, dtype=None):
         """
         Create a stage that can host requests with a size equal to the given shape.
 
         :param shape: A shape that specifies the size of the stage. It may be incomplete, where the remaining
             dimensions will be filled with the dimensions of this dataset.
+        :param prefault: If True, the memory of the stage is allocated immediately, rather than on first use.
+            This moves the cost of page faults out of the first reads into the stage.
+        :param dtype: The datatype of the results the stage should hold, if it differs from that of this dataset.
         :return: A new stage with the requested size.
         """
-        return stage.Stage(numpy_utils._calc_nbytes(self.dtype, self._fill_shape(shape)))
+        return stage.Stage(self._stage_nbytes(shape, dtype), prefault=prefault)
 
-    def create_stage_pool(self, shape, num_stages):
+    def create_stage_pool(self, shape, num_stages, prefault=False, dtype=None):
         """
         Create a pool of stages. Each stage in the pool will be initialised with the given shape.
 
         :param shape: A shape that specifies the size of the stages in this pool. It may be incomplete, where
             the remaining dimensions will be filled with the dimensions of this dataset.
+        :param prefault: If True, the memory of each stage is allocated immediately, rather than on first use.
+        :param dtype: The datatype of the results the stages should hold, if it differs from that of this dataset.
         :return: A stage pool, from which stages can be retrieved.
         """
-        return stage.StagePool(self, shape, num_stages)
+        return stage.StagePool(self, shape, num_stages, prefault=prefault, dtype=dtype)
 
 class TableDataset(Dataset):
     """ Proxy for dataset operations on pytables Tables. """
@@ -118,14 +146,15 @@ class TableDataset(Dataset):
         Proxy an indexing operation on this dataset. The dataset indexing interface is equivalent to the pytables
         dataset indexing interface.
         """
-        if key is Ellipsis:
-            raise IndexError("Pytables does not support a single ellipsis index.")
-        elif isinstance(key, str):
-            return self.col(key)
+        # The most common key types are checked first.
+        if isinstance(key, slice):
+            return ReadOpTable(self._path, None, key.start, key.stop, key.step)
         elif isinstance(key, int):
             return ReadScalarOpTable(self._path, None, key)
-        elif isinstance(key, slice):
-            return ReadOpTable(self._path, None, key.start, key.stop, key.step)
+        elif isinstance(key, str):
+            return self.col(key)
+        elif key is Ellipsis:
+            raise IndexError("Pytables does not support a single ellipsis index.")
         elif _is_simple_slice(key):
             key = key[0]
             return ReadOpTable(self._path, None, key.start, key.stop, key.step)
@@ -148,12 +177,13 @@ class ArrayDataset(Dataset):
         Proxy an indexing operation on this dataset. The dataset indexing interface is equivalent to the pytables
         dataset indexing interface.
         """
-        if key is Ellipsis:
-            raise IndexError("Pytables does not support a single ellipsis index.")
+        # The most common key types are checked first.
+        if isinstance(key, slice):
+            return ReadOpArray(self._path, None, key.start, key.stop, key.step)
         elif isinstance(key, int):
             return ReadScalarOpArray(self._path, None, key)
-        elif isinstance(key, slice):
-            return ReadOpArray(self._path, None, key.start, key.stop, key.step)
+        elif key is Ellipsis:
+            raise IndexError("Pytables does not support a single ellipsis index.")
         elif _is_simple_slice(key):
             key = key[0]
             return ReadOpArray(self._path, None, key.start, key.stop, key.step)
@@ -4,6 +4,7 @@
 # of the MIT license.  See the LICENSE.txt file for details.
 
 import numpy as np
+from contextlib import contextmanager
 
 from . import msgpack_ext
 from .msgpack_ext import msgpack_registry
@@ -11,10 +12,9 @@ from .msgpack_ext import msgpack_registry
 import sys
 _PYTHON3 = sys.version_info > (3, 0)
 
-if _PYTHON3:
-    genrange = range
-else:
-    genrange = xrange
+# Cache of the datatype and shape of each column, keyed by the table datatype and the column name. The same
+# columns are requested over and over by the reader processes, so they are only looked up once.
+_col_dtype_shapes = {}
 
 def _predict_idx_shape_col(dtype, shape, name):
     """
@@ -25,16 +25,19 @@ def _predict_idx_shape_col(dtype, shape, name):
     :return: A tuple, the first element is the numpy datatype of the requested column, the second element
         is the shape for the result of the column indexing operation.
     """
-    if name not in dtype.fields:
-        raise NameError("Specified column name '" + name + "' not in dataset.")
-    coldtype = dtype[name]
-    subdtype = coldtype.subdtype
-    if subdtype is None:
-        colshape = ()
-    else:
-        coldtype, colshape = subdtype
-    new_shape = list(shape) + list(colshape)
-    return coldtype, tuple(new_shape)
+    try:
+        coldtype, colshape = _col_dtype_shapes[(dtype, name)]
+    except KeyError:
+        if name not in dtype.fields:
+            raise NameError("Specified column name '" + name + "' not in dataset.")
+        coldtype = dtype[name]
+        subdtype = coldtype.subdtype
+        if subdtype is None:
+            colshape = ()
+        else:
+            coldtype, colshape = subdtype
+        _col_dtype_shapes[(dtype, name)] = coldtype, colshape
+    return coldtype, tuple(shape) + tuple(colshape)
 
 def _predict_idx_shape_slice(shape, slice):
     """
@@ -43,7 +46,13 @@ def _predict_idx_shape_slice(shape, slice):
     :param slice: The slice operation that will be performed on the array.
     :return: The shape of the resulting slice operation.
     """
-    return ( len(genrange(*slice.indices(shape[0]))), ) + shape[1:]
+    start, stop, step = slice.indices(shape[0])
+    # The length of the range, calculated directly rather than by constructing the range.
+    if step > 0:
+        length = (stop - start + step - 1)//step
+    else:
+        length = (stop - start + step + 1)//step
+    return ( max(0, length), ) + shape[1:]
 
 def _is_simple_slice(key):
     """
@@ -53,7 +62,7 @@ def _is_simple_slice(key):
     :param key: The indexing operation.
     :return: True if the indexing operation is a simple slice.
     """
-    return isinstance(key, tuple) and len(key) > 0 and isinstance(key[0], slice) and np.all([ (k is slice and k == np.s_[:]) or k is Ellipsis for k in key[1:]])
+    return isinstance(key, tuple) and len(key) > 0 and isinstance(key[0], slice) and all((isinstance(k, slice) and k == np.s_[:]) or k is Ellipsis for k in key[1:])
 
 def _is_coords(key):
     """
@@ -61,7 +70,25 @@ def _is_coords(key):
     :param key: The indexing operation.
     :return: True if the indexing operation is a point selection.
     """
-    return isinstance(key, list) or (isinstance(key, np.ndarray) and np.issubdtype(key.dtype, np.integer))
+    # The kind of the datatype is checked directly, as it is cheaper than walking the numpy type hierarchy.
+    return isinstance(key, list) or (isinstance(key, np.ndarray) and key.dtype.kind in 'iu')
+
+if _PYTHON3:
+    _immutable_types = (int, float, str, bytes, np.generic, type(None), type(Ellipsis))
+else:
+    _immutable_types = (int, long, float, str, unicode, np.generic, type(None), type(Ellipsis))
+
+def _is_immutable(value):
+    """
+    A helper function for determining if an operation argument cannot be changed after it has been given.
+    :param value: The argument, such as an index or a column name.
+    :return: True if the argument is a scalar, a string, None, an ellipsis, or a slice or tuple of these.
+    """
+    if isinstance(value, tuple):
+        return all(_is_immutable(v) for v in value)
+    elif isinstance(value, slice):
+        return _is_immutable(value.start) and _is_immutable(value.stop) and _is_immutable(value.step)
+    return isinstance(value, _immutable_types)
 
 class OpBase(msgpack_ext.MsgpackExtType):
     """ Base class type for indexing operations. Defines basic numpy style indexing. """
@@ -69,6 +96,7 @@ class OpBase(msgpack_ext.MsgpackExtType):
     def __init__(self, path):
         self._path = path
         self._index = None
+        self._packed = None
 
     def _apply_index(self, ary):
         """
@@ -78,7 +106,8 @@ class OpBase(msgpack_ext.MsgpackExtType):
         """
         if self._index is not None:
             for key in self._index:
-                if hasattr(ary, 'size_on_disk') and isinstance(key, np.ndarray) and not key.flags.writeable:
+                # The type of the key is checked first, as the attribute probe is only needed for array keys.
+                if isinstance(key, np.ndarray) and not key.flags.writeable and hasattr(ary, 'size_on_disk'):
                     # pytables can write to the key sometimes, so create a writable key
                     key = np.array(key, copy=True)
                 ary = ary[key]
@@ -92,8 +121,39 @@ class OpBase(msgpack_ext.MsgpackExtType):
             self._index = [key]
         else:
             self._index.append(key)
+        # The operation has changed, so it must be packed again.
+        self._packed = None
         return self
 
+    def _pack(self, packer):
+        """
+        Pack this operation into bytes. The result is kept, so that an operation that is requested repeatedly is
+        only packed once. Indexing the operation further discards the kept result. The result is only kept when
+        every argument and index of the operation is immutable (see _is_immutable). Arguments such as lists, numpy
+        arrays, dictionaries or other operations can be changed by the caller after the operation is created,
+        without the operation knowing, so an operation holding any of them is packed again on every request.
+        :param packer: The msgpack extension manager to pack this operation with.
+        :return: A string of bytes that describes this operation.
+        """
+        packed = getattr(self, '_packed', None)
+        if packed is None:
+            packed = packer.pack(self)
+            # The index list itself is owned by this operation, only the keys it holds need to be checked.
+            if all(_is_immutable(tuple(self._index or ()) if name == '_index' else getattr(self, name))
+                   for name in self._pack_map):
+                self._packed = packed
+        return packed
+
+    def astype(self, dtype):
+        """
+        Cast the result of this operation to the given datatype before it is stored in the stage. This happens in
+        the reader processes, so a narrower datatype also reduces the size of the stage that is required.
+        :param dtype: The numpy datatype of the result. Structured datatypes are not supported.
+        :return: An operation that performs this operation and then the cast.
+        """
+        return CastOp(self._path, self, dtype)
+
+    __slots__ = ('_path', '_index', '_packed')
     _pack_map = msgpack_ext.MsgpackExtType._pack_map + ['_path', '_index']
 
 
@@ -121,6 +181,7 @@ class IndexOp(OpBase):
         out_buf.set_to(result)
         return result.dtype, result.shape
 
+    __slots__ = ()
     _pack_map = OpBase._pack_map
 msgpack_registry.register_class(IndexOp)
 
@@ -132,6 +193,13 @@ class ColOp(OpBase):
         self._col = col
 
     def _apply(self, node, out_buf):
+        if self._index is None:
+            # Without subsequent indexing operations, the column can be read directly into the shared buffer,
+            # avoiding a temporary copy of the whole column.
+            dtype, shape = _predict_idx_shape_col(node.dtype, node.shape, self._col)
+            with out_buf.asarray_direct(dtype, shape) as ary:
+                node.read(field=self._col, out=ary)
+            return dtype, shape
         result = self._apply_index(node.col(self._col))
         out_buf.set_to(result)
         return result.dtype, result.shape
@@ -151,9 +219,21 @@ class ColOp(OpBase):
         elif _is_coords(key):
             # A column index, followed by point selection, can be optimised to point selection.
             return CoordOp(self._path, self._col, key)
+        elif isinstance(key, tuple) and len(key) > 0 and isinstance(key[0], slice):
+            # A column index, followed by a slice with further indices, can be optimised to a read of just the
+            # sliced rows. The remaining indices are then applied to the rows that were read.
+            op = ReadOpTable(self._path, self._col, key[0].start, key[0].stop, key[0].step)
+            return op[(slice(None),) + key[1:]]
+        elif isinstance(key, tuple) and len(key) > 0 and isinstance(key[0], int) and key[0] >= 0 \
+                and not any(isinstance(k, (list, np.ndarray)) for k in key[1:]):
+            # As above, but for a scalar index followed by further basic indices. Numpy treats a scalar index as an
+            # advanced index when other advanced indices are present, which can move the resulting axes, so those
+            # keys are left to the general case.
+            return ReadScalarOpTable(self._path, self._col, key[0])[key[1:]]
         else:
             return super(ColOp, self).__getitem__(key)
 
+    __slots__ = ('_col',)
     _pack_map = OpBase._pack_map + ['_col']
 msgpack_registry.register_class(ColOp)
 
@@ -218,6 +298,7 @@ class ReadOpBase(OpBase):
             return self._apply_with_index(node, out_buf)
             
 
+    __slots__ = ('_col', '_start', '_stop', '_step')
     _pack_map = OpBase._pack_map + ['_col', '_start', '_stop', '_step']
 
 class ReadOpTable(ReadOpBase):
@@ -235,6 +316,7 @@ class ReadOpTable(ReadOpBase):
         else:
             return super(ReadOpTable, self).__getitem__(key)
 
+    __slots__ = ()
     _pack_map = ReadOpBase._pack_map
 msgpack_registry.register_class(ReadOpTable)
 
@@ -247,6 +329,7 @@ class ReadOpArray(ReadOpBase):
     def _read(self, node):
         return self._apply_index(node.read(start=self._start, stop=self._stop, step=self._step))
 
+    __slots__ = ()
     _pack_map = ReadOpBase._pack_map
 msgpack_registry.register_class(ReadOpArray)
     
@@ -265,6 +348,7 @@ class ReadScalarOpBase(ReadOpBase):
         # Then the result shape can truncate out the first dimension, resulting in a scalar.
         return dtype, shape[1:]
 
+    __slots__ = ()
     _pack_map = ReadOpBase._pack_map
 
 class ReadScalarOpTable(ReadScalarOpBase, ReadOpTable):
@@ -279,6 +363,7 @@ class ReadScalarOpTable(ReadScalarOpBase, ReadOpTable):
         else:
             return super(ReadScalarOpTable, self).__getitem__(key)
 
+    __slots__ = ()
     _pack_map = ReadScalarOpBase._pack_map
 msgpack_registry.register_class(ReadScalarOpTable)
 
@@ -288,6 +373,7 @@ class ReadScalarOpArray(ReadScalarOpBase, ReadOpArray):
     def _read(self, node):
         return self._apply_index(node.read(start=self._start, stop=self._stop, step=self._step)[0])
 
+    __slots__ = ()
     _pack_map = ReadScalarOpBase._pack_map
 msgpack_registry.register_class(ReadScalarOpArray)
 
@@ -313,7 +399,7 @@ class JoinedSlicesOp(OpBase):
         return dtype, shape
 
     def _read_to(self, node, out):
-        out_stop1 = (self._stop1 - self._start1)
+        out_stop1 = _predict_idx_shape_slice(node.shape, slice(self._start1, self._stop1, self._step1))[0]
         if self._col is None:
             node.read(start=self._start1, stop=self._stop1, step=self._step1, out=out[:out_stop1])
             node.read(start=self._start2, stop=self._stop2, step=self._step2, out=out[out_stop1:])
@@ -322,13 +408,11 @@ class JoinedSlicesOp(OpBase):
             node.read(start=self._start2, stop=self._stop2, step=self._step2, field=self._col, out=out[out_stop1:])
 
     def _read(self, node):
-        if self._col is None:
-            slice1 = node.read(start=self._start1, stop=self._stop1, step=self._step1)
-            slice2 = node.read(start=self._start2, stop=self._stop2, step=self._step2)
-        else:
-            slice1 = node.read(start=self._start1, stop=self._stop1, step=self._step1, field=self._col)
-            slice2 = node.read(start=self._start2, stop=self._stop2, step=self._step2, field=self._col)
-        return self._apply_index(np.concatenate((slice1, slice2), axis=0))
+        # Read both slices directly into the two halves of a single array, rather than concatenating them.
+        dtype, shape = self._dtype_shape(node.dtype, node.shape)
+        result = np.empty(shape, dtype=dtype)
+        self._read_to(node, result)
+        return self._apply_index(result)
 
     def _apply(self, node, out_buf):
         if self._index is None:
@@ -342,6 +426,7 @@ class JoinedSlicesOp(OpBase):
             out_buf.set_to(result)
             return result.dtype, result.shape
 
+    __slots__ = ('_col', '_start1', '_stop1', '_step1', '_start2', '_stop2', '_step2')
     _pack_map = OpBase._pack_map + ['_col', '_start1', '_stop1', '_step1', '_start2', '_stop2', '_step2']
 msgpack_registry.register_class(JoinedSlicesOp)
 
@@ -352,17 +437,40 @@ class CoordOp(OpBase):
         self._col = col
         self._coords = coords
 
+    def _read(self, node):
+        """
+        Read the points at the coordinates of this operation, in the order of the coordinates.
+        """
+        coords = np.asarray(self._coords)
+        if coords.ndim == 1 and len(coords) > 1 and np.any(coords[1:] < coords[:-1]):
+            # Unordered points are read in on-disk order, so that the reads sweep through the dataset once, and are
+            # then put back into the requested order.
+            order = np.argsort(coords, kind='stable')
+            points = node.read_coordinates(coords[order], field=self._col)
+            result = np.empty_like(points)
+            result[order] = points
+            return result
+        return node.read_coordinates(self._coords, field=self._col)
+
     def _apply(self, node, out_buf):
-        result = self._apply_index(node.read_coordinates(self._coords, field=self._col))
+        result = self._apply_index(self._read(node))
         out_buf.set_to(result)
         return result.dtype, result.shape
     
     def __getitem__(self, key):
         if isinstance(key, str) and self._col is None:
             return CoordOp(self._path, key, self._coords)
+        elif self._index is None and isinstance(key, slice):
+            # A slice of the selected points can be applied to the coordinates, so that only those points are read.
+            return CoordOp(self._path, self._col, self._coords[key])
+        elif self._index is None and isinstance(key, tuple) and len(key) > 0 and isinstance(key[0], slice):
+            # As above, with the remaining indices applied to the points that were read.
+            op = CoordOp(self._path, self._col, self._coords[key[0]])
+            return super(CoordOp, op).__getitem__((slice(None),) + key[1:])
         else:
             return super(CoordOp, self).__getitem__(key)
 
+    __slots__ = ('_col', '_coords')
     _pack_map = OpBase._pack_map + ['_col', '_coords']
 msgpack_registry.register_class(CoordOp)
 
@@ -395,24 +503,27 @@ class SortOp(OpBase):
         else:
             return super(SortOp, self).__getitem__(key)
 
+    __slots__ = ('_sortby', '_checkCSI', '_col', '_start', '_stop', '_step')
     _pack_map = OpBase._pack_map + ['_sortby', '_checkCSI', '_col', '_start', '_stop', '_step']
 msgpack_registry.register_class(SortOp)
 
 class WhereOp(OpBase):
     """ Class for proxying pytables conditional indexing. """
 
-    def __init__(self, path, condition, condvars, start, stop, step):
+    def __init__(self, path, condition, condvars, start, stop, step, col=None):
         super(WhereOp, self).__init__(path)
         self._condition = condition
         self._condvars = condvars
         self._start = start
         self._stop = stop
         self._step = step
+        self._col = col
 
     def _apply(self, node, out_buf):
         result = self._apply_index(node.read_where(
             condition = self._condition,
             condvars = self._condvars,
+            field = self._col,
             start = self._start,
             stop = self._stop,
             step = self._step
@@ -420,5 +531,52 @@ class WhereOp(OpBase):
         out_buf.set_to(result)
         return result.dtype, result.shape
 
-    _pack_map = OpBase._pack_map + ['_condition', '_condvars', '_start', '_stop', '_step']
-msgpack_registry.register_class(WhereOp)
\ No newline at end of file
+    def __getitem__(self, key):
+        if isinstance(key, str) and self._col is None and self._index is None:
+            # Selecting a column of the matching rows only reads that column.
+            return WhereOp(self._path, self._condition, self._condvars, self._start, self._stop, self._step, key)
+        else:
+            return super(WhereOp, self).__getitem__(key)
+
+    __slots__ = ('_condition', '_condvars', '_col', '_start', '_stop', '_step')
+    _pack_map = OpBase._pack_map + ['_condition', '_condvars', '_col', '_start', '_stop', '_step']
+msgpack_registry.register_class(WhereOp)
+
+class _ResultBuffer(object):
+    """ Stands in for a shared buffer, so that the result of an operation can be kept as a numpy array. """
+
+    def __init__(self):
+        self.result = None
+
+    @contextmanager
+    def asarray_direct(self, dtype, shape):
+        self.result = np.empty(shape, dtype=dtype)
+        yield self.result
+
+    def set_to(self, value):
+        self.result = value
+
+class CastOp(OpBase):
+    """ Class for casting the result of another operation to a different datatype. """
+
+    def __init__(self, path, op, dtype):
+        super(CastOp, self).__init__(path)
+        dtype = np.dtype(dtype)
+        if dtype.fields is not None:
+            raise TypeError("Cannot cast to the structured datatype {}.".format(dtype))
+        self._op = op
+        self._dtype = dtype.str
+
+    def _apply(self, node, out_buf):
+        # The wrapped operation is applied to a temporary array, which is then cast while it is copied into the stage.
+        result_buf = _ResultBuffer()
+        dtype, shape = self._op._apply(node, result_buf)
+        result = self._apply_index(np.asarray(result_buf.result).reshape(shape))
+        dtype = np.dtype(self._dtype)
+        with out_buf.asarray_direct(dtype, result.shape) as ary:
+            ary[...] = result
+        return dtype, result.shape
+
+    __slots__ = ('_op', '_dtype')
+    _pack_map = OpBase._pack_map + ['_op', '_dtype']
+msgpack_registry.register_class(CastOp)
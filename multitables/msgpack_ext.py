@@ -3,11 +3,40 @@
 # This software may be modified and distributed under the terms
 # of the MIT license.  See the LICENSE.txt file for details.
 
+import struct
+import threading
 import msgpack
 import numpy as np
 
+import sys
+_PYTHON3 = sys.version_info > (3, 0)
+
 from . import numpy_utils
 
+# Headers of the msgpack ext 8, ext 16 and ext 32 formats: the format byte, the data length and the type code.
+_ext8_struct = struct.Struct('>BBb')
+_ext16_struct = struct.Struct('>BHb')
+_ext32_struct = struct.Struct('>BIb')
+# Headers of the msgpack fixarray, array 16 and array 32 formats.
+_fixarray_struct = struct.Struct('>B')
+_array16_struct = struct.Struct('>BH')
+_array32_struct = struct.Struct('>BI')
+
+def pack_packed_list(packed):
+    """
+    Pack a list from items that have each already been packed, by writing the list header in front of them.
+    :param packed: A list of strings of bytes, each describing a packed object.
+    :return: A string of bytes that describes the list of objects.
+    """
+    n = len(packed)
+    if n < 0x10:
+        header = _fixarray_struct.pack(0x90 | n)
+    elif n < 0x10000:
+        header = _array16_struct.pack(0xdc, n)
+    else:
+        header = _array32_struct.pack(0xdd, n)
+    return header + b''.join(packed)
+
 class MsgpackCustomExt:
     """ A custom extension type manager for msgpack """
 
@@ -15,6 +44,13 @@ class MsgpackCustomExt:
         self._packers = {}
         self._unpackers = {}
         self._super_types = []
+        # Packers of the sub-types that have been matched to a registered super-type. These are kept apart from
+        # the registered types, as the type codes are allocated from the number of registered types.
+        self._subtype_packers = {}
+        # Each thread keeps a free list of msgpack packers, so that a packer, and its internal buffer, is reused
+        # across calls rather than created for each one. Extension types are packed recursively from within the
+        # packer, so nested calls take further packers from the list.
+        self._local = threading.local()
     
     def register_class(self, class_type):
         """
@@ -57,7 +93,37 @@ class MsgpackCustomExt:
         :param obj: The object to pack.
         :return: A string of bytes that describes the object.
         """
-        return msgpack.packb(obj, default=self._pack_obj, use_bin_type=True, strict_types=True)
+        try:
+            free_packers = self._local.free_packers
+        except AttributeError:
+            free_packers = self._local.free_packers = []
+        if len(free_packers) > 0:
+            packer = free_packers.pop()
+        else:
+            packer = msgpack.Packer(default=self._pack_obj, use_bin_type=True, strict_types=True)
+        # The packer is only returned to the free list if packing succeeds, so a packer left in an unknown state by
+        # an exception is never reused.
+        result = packer.pack(obj)
+        free_packers.append(packer)
+        return result
+
+    def pack_ext(self, obj):
+        """
+        Pack an object whose exact type has been registered with this manager. The extension type header is written
+        directly, rather than going through the msgpack hook that first has to work out the type of the object.
+        :param obj: The object to pack.
+        :return: A string of bytes that describes the object.
+        """
+        tid, packer = self._packers[type(obj)]
+        data = self.pack(packer(obj))
+        n = len(data)
+        if n < 0x100:
+            header = _ext8_struct.pack(0xc7, n, tid)
+        elif n < 0x10000:
+            header = _ext16_struct.pack(0xc8, n, tid)
+        else:
+            header = _ext32_struct.pack(0xc9, n, tid)
+        return header + data
 
     def unpack(self, data):
         """
@@ -72,17 +138,23 @@ class MsgpackCustomExt:
         """
         The msgpack hook that handles the creation of extension objects for the registered types.
         """
+        obj_type = type(obj)
         try:
-            tid, packer = self._packers[type(obj)]
-            return msgpack.ExtType(tid, self.pack(packer(obj)))
+            tid, packer = self._packers[obj_type]
         except KeyError:
-            if isinstance(obj, int): # Convert int types directly to int, prevents some problematic edge cases.
-                return int(obj)
-            for super_type in self._super_types: # Check to see if the given object is a sub-type of a registered super-type.
-                if isinstance(obj, super_type):
-                    tid, packer = self._packers[super_type]
-                    return msgpack.ExtType(tid, self.pack(packer(obj)))
-            raise TypeError("Type '{}' of object '{}' unknown to msgpack serialiser.".format(type(obj), obj))
+            try:
+                tid, packer = self._subtype_packers[obj_type]
+            except KeyError:
+                if isinstance(obj, int): # Convert int types directly to int, prevents some problematic edge cases.
+                    return int(obj)
+                for super_type in self._super_types: # Check to see if the given object is a sub-type of a registered super-type.
+                    if isinstance(obj, super_type):
+                        # Remember the match, so that later objects of this type skip the search.
+                        tid, packer = self._subtype_packers[obj_type] = self._packers[super_type]
+                        break
+                else:
+                    raise TypeError("Type '{}' of object '{}' unknown to msgpack serialiser.".format(obj_type, obj))
+        return msgpack.ExtType(tid, self.pack(packer(obj)))
 
     def _unpack_obj(self, code, data):
         """
@@ -102,8 +174,8 @@ def create_registry():
 
     # Register slice type
     msgpack_registry.register_obj(slice,
-        lambda obj: {i:x for i, x in enumerate([obj.start, obj.stop, obj.step]) if x is not None},
-        lambda data: slice(*( ( data[i] if i in data else None) for i in range(3) )))
+        lambda obj: [obj.start, obj.stop, obj.step],
+        lambda data: slice(*data))
 
     # Register Ellipsis type
     msgpack_registry.register_obj(type(Ellipsis), lambda obj: u'', lambda data: Ellipsis)
@@ -118,9 +190,13 @@ def create_registry():
         # There is a speed break-even point in a custom encoding, at around 10 elements.
         # Size break-even is substainally larger, but time is more important.
         if ary.size > 10:
+            # The memory of a contiguous array is handed to msgpack directly, rather than being copied into a bytes
+            # object first. It is exposed through a byte view, as numpy cannot export a buffer of some datatypes,
+            # such as datetime64.
+            ary = np.ascontiguousarray(ary)
             return {0: numpy_utils._dtype_descr(ary.dtype), 
                     1: ary.shape,
-                    2: ary.tobytes()}
+                    2: memoryview(ary.reshape(-1).view(np.uint8)) if _PYTHON3 else ary.tobytes()}
         else:
             return ary.tolist()
     def _msgunpack_ndarray(data):
@@ -128,14 +204,22 @@ def create_registry():
             return np.array(data)
         else:
             #return np.array(data[2], dtype=np.dtype(data[0])).reshape(data[1])
-            return np.frombuffer(data[2], dtype=np.dtype(data[0])).reshape(data[1])
+            return np.frombuffer(data[2], dtype=numpy_utils._dtype_from_descr(data[0])).reshape(data[1])
     msgpack_registry.register_obj(np.ndarray, _msgpack_ndarray, _msgunpack_ndarray)
 
     # Register numpy scalar types. The root super-type np.number is registered, and all sub-types directly encoded in
-    # the description. 
+    # the description. The encoded type character of each sub-type is cached, rather than looked up and encoded for
+    # every scalar.
+    scalar_chars = {}
+    def _msgpack_npnumber(obj):
+        try:
+            char = scalar_chars[type(obj)]
+        except KeyError:
+            char = scalar_chars[type(obj)] = obj.dtype.char.encode('utf-8')
+        return char + obj.tobytes()
     msgpack_registry.register_supertype(np.number, 
-        lambda obj: obj.dtype.char.encode('utf-8') + obj.tobytes(), 
-        lambda data: np.frombuffer(data[1:], dtype=np.dtype(data[:1]))[0])
+        _msgpack_npnumber, 
+        lambda data: np.frombuffer(data[1:], dtype=numpy_utils._dtype_from_descr(data[:1]))[0])
 
     # Register numpy bool scalar type. This type is not a sub-type of np.number, so it requires seperate handling.
     msgpack_registry.register_obj(np.bool_, lambda obj: obj.item(), lambda data: data)
@@ -152,28 +236,30 @@ def create_registry():
 
 class MsgpackExtType(object):
     """ A base class that defines a packing and unpacking method that can be used by derived types. """
+    # Derived types may declare their attributes in __slots__, so this base class does not add an instance dictionary.
+    __slots__ = ()
     # _pack_map is a list of attribute names that should be saved and reconstructed by the packer and unpacker.
     _pack_map = []
 
     def __msgpack__(self):
         """
-        Packs this instance into a dictionary, where each element corresponds to an attribute of this object.
-        :return: A dictionary describing this object.
+        Packs this instance into a list, where each element corresponds to an attribute of this object, in the
+        order given by _pack_map.
+        :return: A list describing this object.
         """
-        desc = { i: getattr(self, name) for i, name in enumerate(type(self)._pack_map) if i is not None }
-        return desc
+        return [getattr(self, name) for name in type(self)._pack_map]
 
     @classmethod
     def __msgunpack__(this, data):
         """
-        Static method that unpacks the provided dictionary into a new instance of the derived type.
+        Static method that unpacks the provided list into a new instance of the derived type.
         :param this: The type of the derived class that this static class method was called with.
-        :param data: The dictionary that describes an object instance.
+        :param data: The list that describes an object instance.
         :return: A new instance of the derived type which matches the provided description.
         """
         result = this.__new__(this)
-        for i, name in enumerate(this._pack_map):
-            setattr(result, name, data[i] if i in data else None)
+        for name, value in zip(this._pack_map, data):
+            setattr(result, name, value)
         return result
 
 # A global registry instance.
@@ -185,7 +271,8 @@ class PickleWrapper:
     """ A class that allows fallback to using pickle using the same API as the msgpack extension manager """
     
     def pack(self, obj):
-        return pickle.dumps(obj)
+        # The default protocol of older Pythons is a slower and larger text based format.
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
 
     def unpack(self, data):
         return pickle.loads(data)
@@ -12,10 +12,16 @@ def _calc_nbytes(dtype, shape):
     :param shape: The shape of the array.
     :return: The size in bytes.
     """
-    N_elem = np.prod(shape, dtype=int)
+    # Shapes only have a few dimensions, so a plain loop is much faster than np.prod, which creates an array.
+    N_elem = 1
+    for dim in shape:
+        N_elem *= dim
     size_nbytes = dtype.itemsize * N_elem
     return size_nbytes
 
+# Cache of the descriptions of structured datatypes, which numpy builds afresh on every access.
+_descr_cache = {}
+
 def _dtype_descr(dtype):
     """
     Get a string that describes a numpy datatype.
@@ -23,6 +29,32 @@ def _dtype_descr(dtype):
     :return: A string describing the type.
     """
     if dtype.kind == 'V':
-        return dtype.descr
+        try:
+            return _descr_cache[dtype]
+        except KeyError:
+            descr = _descr_cache[dtype] = dtype.descr
+            return descr
+    elif dtype.kind in 'mM':
+        # The type character of a datetime or timedelta datatype does not include its unit.
+        return dtype.str
     else:
-        return dtype.char
\ No newline at end of file
+        return dtype.char
+
+# Cache of the datatypes created from string descriptions.
+_dtype_cache = {}
+
+def _dtype_from_descr(descr):
+    """
+    Get the numpy datatype for a description, as produced by _dtype_descr. Datatypes described by a string are
+    cached, as only a handful are ever seen. Structured descriptions are lists, which are cheaper to convert directly
+    than to make hashable.
+    :param descr: The datatype description.
+    :return: The numpy datatype.
+    """
+    if isinstance(descr, list):
+        return np.dtype(descr)
+    try:
+        return _dtype_cache[descr]
+    except KeyError:
+        dtype = _dtype_cache[descr] = np.dtype(descr)
+        return dtype
@@ -3,11 +3,12 @@
 # This software may be modified and distributed under the terms
 # of the MIT license.  See the LICENSE.txt file for details.
 
+import os
 import struct
 import multiprocessing
+import multiprocessing.sharedctypes
 import threading
 from contextlib import contextmanager
-import numpy as np
 
 import sys
 _PYTHON3 = sys.version_info > (3, 0)
@@ -23,29 +24,46 @@ from . import shared_queue
 from . import signals
 from .signals import QueueClosed
 from . import dataset
+from . import dataset_ops
 from . import request
 
 from . import msgpack_ext
 request_packer = msgpack_ext.msgpack_registry
 return_packer = msgpack_ext.PickleWrapper()
 
-def _Reader__read_process(self):
+# When a request key is stored in the stage, the last bytes of the stage store the size of the key data.
+_keysize_struct = struct.Struct('@I')
+
+# The most notifications that the notification spool takes from the queue at once.
+_NOTIFY_BATCH = 32
+
+def _Reader__read_process(self, proc_idx):
     """
     The main read process for fielding requests. This function is defined outside of the reader class as
     older versions of Python have issues with processes being launched with class methods as targets.
     :param self: An instance of the Reader class.
+    :param proc_idx: The index of this process amongst the reader processes.
     """
     try:
+        if self._affinity is not None:
+            # Pin this process to its CPU, so that it does not migrate between cores while decoding.
+            os.sched_setaffinity(0, [self._affinity[proc_idx % len(self._affinity)]])
+
         h5_file = self._open_h5_file()
         # Define caches for nodes and buffers.
         nodes = {}
         bufs = {}
 
-        while not self._stop.is_set():
+        # Bind the attributes used on every request once, outside of the loop.
+        done = self._done
+        get_direct = self._queue.get_direct
+        notify_put = self._notify.put
+
+        while not done.value:
             
             try:
                 # Attempt to get a request from the request queue.
-                with self._queue.get_direct(timeout=0.1) as data:
+                with get_direct(timeout=0.1) as data:
                     req = request_packer.unpack(data)
                 data = None
             except queue.Empty:
@@ -57,48 +75,52 @@ def _Reader__read_process(self):
                         del bufs[k]
                 continue
 
-            # If the reader object has been closed, start the shutdown procedure.
+            # If the reader object has been closed, start the shutdown procedure. The sentinel is the last item in the
+            # queue, so the other processes are told to finish through the shared flag rather than by passing it on.
             if req is QueueClosed:
-                self._queue.put(request_packer.pack(QueueClosed))
+                done.value = True
                 break
 
-            try:
-
-                # Caching of the shared memory is a larger performance improvement
-                map_id = req.map_id
+            # Several requests may be queued together as a list.
+            for req in (req if type(req) is list else (req,)):
                 try:
-                    shm_ary = bufs[map_id]
-                except KeyError:
-                    shm_ary = shared_mem.SharedBuffer(map_id=map_id, size_nbytes=req.size_nbytes)
-                    bufs[map_id] = shm_ary
-
-                # If the request key is not present, it means that it has been stored in the stage instead
-                if req.key is None:
-                    # Retrieve the key from the stage
-                    with shm_ary.get_direct() as buf:
-                        keysize, = struct.unpack('@I', buf[-4:])
-                        req.key = request_packer.unpack(buf[:keysize])
-                else:
-                    # Retrieve the key from the request data
-                    req.key = request_packer.unpack(req.key)
 
-                # Caching of the node is extraordinarily marginal performance improvement, but might as well
-                path = req.key._path
-                try:
-                    node = nodes[path]
-                except KeyError:
-                    node = h5_file.get_node(path)
-                    nodes[path] = node
+                    # Caching of the shared memory is a larger performance improvement
+                    map_id = req.map_id
+                    try:
+                        shm_ary = bufs[map_id]
+                    except KeyError:
+                        shm_ary = shared_mem.SharedBuffer(map_id=map_id, size_nbytes=req.size_nbytes)
+                        bufs[map_id] = shm_ary
+
+                    # If the request key is not present, it means that it has been stored in the stage instead
+                    if req.key is None:
+                        # Retrieve the key from the stage
+                        with shm_ary.get_direct() as buf:
+                            keysize, = _keysize_struct.unpack_from(buf, len(buf) - _keysize_struct.size)
+                            # The buffer is a memoryview, so the key is unpacked straight from the shared memory.
+                            req.key = request_packer.unpack(buf[:keysize])
+                    else:
+                        # Retrieve the key from the request data
+                        req.key = request_packer.unpack(req.key)
+
+                    # Caching of the node is extraordinarily marginal performance improvement, but might as well
+                    path = req.key._path
+                    try:
+                        node = nodes[path]
+                    except KeyError:
+                        node = h5_file.get_node(path)
+                        nodes[path] = node
                 
-                # This accesses the node and stores the reqeusted data in shm_ary, the data type and shape
-                # of the result is returned.
-                dtype, shape = req.key._apply(node, shm_ary)
-                # Place the result meta-data into the notification queue.
-                self._notify.put(return_packer.pack((req.req_id, numpy_utils._dtype_descr(dtype), shape)))
-
-            # If there was an exception while accessing the data, notify the caller of the exception.
-            except Exception as e:
-                self._handle_exception(req.req_id, e)
+                    # This accesses the node and stores the reqeusted data in shm_ary, the data type and shape
+                    # of the result is returned.
+                    dtype, shape = req.key._apply(node, shm_ary)
+                    # Place the result meta-data into the notification queue.
+                    notify_put(return_packer.pack((req.req_id, numpy_utils._dtype_descr(dtype), shape)))
+
+                # If there was an exception while accessing the data, notify the caller of the exception.
+                except Exception as e:
+                    self._handle_exception(req.req_id, e)
     except KeyboardInterrupt as e:
         self._handle_exception(None, e)
     except Exception as e:
@@ -109,11 +131,17 @@ def _Reader__read_process(self):
         # Check for this case, and if everything is OK, close the HDF5 file.
         if 'h5_file' in locals():
             h5_file.close()
+        # The last process to finish notifies the notify spool that it should close down.
+        with self._n_finished_lock:
+            self._n_finished.value += 1
+            last = (self._n_finished.value == self._n_procs)
+        if last:
+            self._notify.put(return_packer.pack((QueueClosed,)))
 
 class Reader:
     """Provides methods for random access of HDF5 datasets."""
 
-    def __init__(self, filename, n_procs=4, notify=None, **kw_args):
+    def __init__(self, filename, n_procs=4, notify=None, affinity=None, **kw_args):
         """
         An object for reading data from filename. Additional key words arguments can be passed to the constructor.
         These arguments will be passed on to the open_file function from PyTables.
@@ -121,49 +149,59 @@ class Reader:
         :param filename: The HDF5 file to read from.
         :param n_procs: The number of background processes to use for fielding requests.
         :param notify: A function that takes one argument, will be called in a seperate thread whenever a request has been fulfilled.
+        :param affinity: An optional list of CPU numbers. Each background process is pinned to one of the CPUs, in
+            turn. Only supported on platforms that provide os.sched_setaffinity.
         :param kw_args: Additional options for opening the HDF5 file.
         """
         # An exception could happen in the construction of the core, causing a further exception when __del__ 
         # is called, as the self._core attribute will not exist.
         self._core = None
-        self._core = Reader.Core(filename, n_procs, notify, kw_args)
+        self._core = Reader.Core(filename, n_procs, notify, affinity, kw_args)
 
     class Core:
-        def __init__(self, filename, n_procs, notify, kw_args):
+        def __init__(self, filename, n_procs, notify, affinity, kw_args):
             self._filename = filename
             self._h5_kw_args = kw_args
+            if affinity is not None:
+                if not hasattr(os, 'sched_setaffinity'):
+                    raise NotImplementedError("Setting the CPU affinity is not supported on this platform.")
+                affinity = list(affinity)
+            self._affinity = affinity
             # _queue is the request queue
             self._queue = shared_queue.SharedQueue(1024, 50)
             # Once requests have been handled, their result meta-data get placed in the _notify queue for dispatch.
             self._notify = shared_queue.SharedQueue(1024, 50)
-            self._next_req_id = 0
 
-            # Signal event for stopping the threads/processes launched by this object.
-            self._stop = multiprocessing.Event()
+            # Shared flag for stopping the processes launched by this object. It is raised either when the reader is
+            # stopped, or when the request queue has been drained after the reader was closed. A plain shared value
+            # is used, as it is polled on every iteration of the read processes and setting it is never undone.
+            self._done = multiprocessing.sharedctypes.RawValue('b', False)
+            # Count of the processes that have finished, so that the last one can signal the shutdown without a
+            # separate thread waiting on all of them.
+            self._n_procs = n_procs
+            self._n_finished = multiprocessing.sharedctypes.RawValue('l', 0)
+            self._n_finished_lock = multiprocessing.Lock()
 
             procs = []
-            for _ in range(n_procs):
+            for proc_idx in range(n_procs):
                 process = multiprocessing.Process(target=_Reader__read_process, args=(
-                    self,
+                    self, proc_idx
                 ))
                 process.start()
                 procs.append(process)
 
-            def monitor():
-                for p in procs:
-                    p.join()
-            
-                # Once all reader processes have terminated, notify the notify spool that it should closed down.
-                self._notify.put(return_packer.pack((QueueClosed,)))
-
-            self._monitor_thread = threading.Thread(target=monitor)
-            self._monitor_thread.start()
-
             # Signal event for closing the threads/processes launched by this object.
             self._close = threading.Event()
 
-            # This dictionary keeps track of currently pending requests.
-            self._open_reqs_dict = {}
+            # Cache of the dataset descriptions, so that the HDF5 file need not be reopened for each dataset proxy.
+            self._datasets = {}
+            self._datasets_lock = threading.Lock()
+
+            # This list keeps track of currently pending requests, indexed by their request ID. The IDs of fulfilled
+            # requests are recycled through the free list, so the list only grows to the largest number of requests
+            # that have been pending at once.
+            self._open_reqs_list = []
+            self._free_req_ids = []
             self._open_reqs_lock = threading.Lock()
 
             def notify_spool():
@@ -173,54 +211,61 @@ class Reader:
                 during the fulfillment of a request, the exception is passed to the request object so that it
                 can be re-raised where the request was made.
                 """
+                # Bind the attributes used for every notification once, outside of the loop. The pending requests
+                # list is only ever modified in place, so it can be bound as well.
+                get_direct_batch = self._notify.get_direct_batch
+                unpack = return_packer.unpack
+                dtype_from_descr = numpy_utils._dtype_from_descr
+                open_reqs = self._open_reqs_list
+                free_open_req = self._free_open_req
+
                 while True:
-                    # Get the next notification.
-                    with self._notify.get_direct() as msg:
-                        notification = return_packer.unpack(msg)
-                    if len(notification) == 3:
-                        # If the notification is for a fulfilled request.
-                        with self._open_reqs() as open_reqs:
+                    # Get all of the waiting notifications at once, and unpack them before their memory is handed
+                    # back to the queue.
+                    with get_direct_batch(_NOTIFY_BATCH) as msgs:
+                        notifications = [unpack(msg) for msg in msgs]
+                    for notification in notifications:
+                        if len(notification) == 3:
+                            # If the notification is for a fulfilled request.
+                            # The pending requests lock is not needed here, see _free_open_req.
                             req_id, dtype, shape = notification # Get the result meta-data
                             # Find the request object, and notify it of the result + meta-data
-                            open_reqs[req_id]._notify(np.dtype(dtype), shape)
+                            req = open_reqs[req_id]
+                            req._notify(dtype_from_descr(dtype), shape)
                             # If the global notification call-back has been specified, also notify it
                             if notify is not None:
-                                notify(open_reqs[req_id])
-                            # Remove the request object from the pending request dictionary
-                            del open_reqs[req_id]
-                    else:
-                        # Otherwise, this request means either an exception happened or the reader has closed.
-                        notification = notification[0]
-                        if notification is QueueClosed:
-                            # If the reader has closed, begin the shutdown process.
-                            if notify is not None:
-                                # Let the global call-back know that this reader is shutting down.
-                                notify(QueueClosed)
-                            with self._open_reqs() as open_reqs:
+                                notify(req)
+                            # Remove the request object from the pending requests, and free its ID
+                            free_open_req(req_id)
+                        else:
+                            # Otherwise, this request means either an exception happened or the reader has closed.
+                            notification = notification[0]
+                            if notification is QueueClosed:
+                                # If the reader has closed, begin the shutdown process. All reader processes have
+                                # finished by this point, so joining them only reaps them.
+                                for p in procs:
+                                    p.join()
+                                if notify is not None:
+                                    # Let the global call-back know that this reader is shutting down.
+                                    notify(QueueClosed)
                                 # Now let all pending requests know that the reader has closed and they can no longer
                                 # be fulfilled.
-                                for key in open_reqs.keys():
-                                    open_reqs[key]._notify(None, None, signals.QueueClosedException("This reader has been closed."))
-                                open_reqs.clear()
-                            break
-                        elif isinstance(notification, Exception):
-                            # If an exception happened
-                            e = notification
-                            if e.__req_id__ is None:
-                                # Error happened when opening file, or reading stop event
-                                # Something went very wrong, clear all and stop.
-                                with self._open_reqs() as open_reqs:
-                                    for key in open_reqs.keys():
-                                        open_reqs[key]._notify(None, None, e)
-                                    open_reqs.clear()
-                                self.close()
-                                raise signals.CreateSubprocessException(e)
-                            else:
-                                # Error happened when reading data, probably localised,
-                                # so propagate it back to the offending request.
-                                with self._open_reqs() as open_reqs:
-                                    open_reqs[e.__req_id__]._notify(None, None, e)
-                                    del open_reqs[e.__req_id__]
+                                self._clear_open_reqs(signals.QueueClosedException("This reader has been closed."))
+                                return
+                            elif isinstance(notification, Exception):
+                                # If an exception happened
+                                e = notification
+                                if e.__req_id__ is None:
+                                    # Error happened when opening file, or reading stop event
+                                    # Something went very wrong, clear all and stop.
+                                    self._clear_open_reqs(e)
+                                    self.close()
+                                    raise signals.CreateSubprocessException(e)
+                                else:
+                                    # Error happened when reading data, probably localised,
+                                    # so propagate it back to the offending request.
+                                    self._open_reqs_list[e.__req_id__]._notify(None, None, e)
+                                    self._free_open_req(e.__req_id__)
 
             self._notify_thread = threading.Thread(target=notify_spool)
             self._notify_thread.start()
@@ -248,17 +293,45 @@ class Reader:
         @contextmanager
         def _open_reqs(self):
             """
-            Context manager for controlling access to the pending requests dictionary.
+            Context manager for controlling access to the pending requests list.
             """
             with self._open_reqs_lock:
-                yield self._open_reqs_dict
+                yield self._open_reqs_list
+
+        def _free_open_req(self, req_id):
+            """
+            Remove a request from the pending requests list, and make its ID available for reuse. The lock is only
+            needed to allocate request IDs: requests are only ever removed by the notification spool, a request is in
+            the list before it is queued, and the list stores and appends are atomic.
+            :param req_id: The request ID number of the request to remove.
+            """
+            self._open_reqs_list[req_id] = None
+            self._free_req_ids.append(req_id)
+
+        def _clear_open_reqs(self, e):
+            """
+            Notify all pending requests of an exception, and then remove them.
+            :param e: The exception that will be raised by the pending requests.
+            """
+            with self._open_reqs() as open_reqs:
+                for req_id, req in enumerate(open_reqs):
+                    if req is not None:
+                        req._notify(None, None, e)
+                        self._free_open_req(req_id)
 
         def _put_queue(self, obj):
             """
-            Helper method for placing and object into the request queue.
-            :param obj: The object to be placed in the queue.
+            Helper method for placing a request into the request queue.
+            :param obj: The RequestDetails object to be placed in the queue.
             """
-            self._queue.put_async(request_packer.pack(obj))
+            self._queue.put_async(request_packer.pack_ext(obj))
+
+        def _put_queue_packed(self, packed):
+            """
+            Helper method for placing a number of requests into the request queue as a single list.
+            :param packed: A list of packed RequestDetails objects.
+            """
+            self._queue.put_async(msgpack_ext.pack_packed_list(packed))
 
         def get_dataset(self, path):
             """
@@ -266,25 +339,38 @@ class Reader:
             :param path: The internal HDF5 path to the dataset within the HDF5 file.
             :return: A dataset proxy object.
             """
+            with self._datasets_lock:
+                try:
+                    node_type, dtype, shape = self._datasets[path]
+                except KeyError:
+                    node_type, dtype, shape = self._datasets[path] = self._describe_dataset(path)
+
+            return node_type(self, path, dtype, shape)
+
+        def _describe_dataset(self, path):
+            """
+            Open the HDF5 file and retrieve the information needed to create a dataset proxy.
+            :param path: The internal HDF5 path to the dataset within the HDF5 file.
+            :return: A tuple of the dataset proxy type, the datatype and the shape of the dataset.
+            """
             import tables as tb
             h5_file = self._open_h5_file()
-            h5_ary = h5_file.get_node(path)
-
-            node_type = None
-            if isinstance(h5_ary, tb.Table):
-                node_type = dataset.TableDataset
-            elif isinstance(h5_ary, tb.Array):
-                node_type = dataset.ArrayDataset
-            elif isinstance(h5_ary, tb.VLArray):
-                node_type = dataset.VLArrayDataset
-            else:
-                raise RuntimeError("Selected dataset is not an array or table.")
-        
-            dtype = h5_ary.dtype
-            shape = h5_ary.shape
-            h5_file.close()
+            try:
+                h5_ary = h5_file.get_node(path)
+
+                node_type = None
+                if isinstance(h5_ary, tb.Table):
+                    node_type = dataset.TableDataset
+                elif isinstance(h5_ary, tb.Array):
+                    node_type = dataset.ArrayDataset
+                elif isinstance(h5_ary, tb.VLArray):
+                    node_type = dataset.VLArrayDataset
+                else:
+                    raise RuntimeError("Selected dataset is not an array or table.")
 
-            return node_type(self, path, dtype, shape)
+                return node_type, h5_ary.dtype, h5_ary.shape
+            finally:
+                h5_file.close()
 
         def request(self, key, stage):
             """
@@ -296,43 +382,102 @@ class Reader:
             :param stage: A stage or stage pool in which the result will be stored.
             :return: A request object.
             """
+            req, details = self._make_request(key, stage)
+            self._put_queue(details)
+            return req
+
+        def request_many(self, keys, stages):
+            """
+            Generate and queue a number of requests at once. The requests are placed into the request queue together,
+            packing as many as fit into each element of the queue, rather than one at a time.
+            :param keys: A sequence of operations created by dataset proxies.
+            :param stages: A sequence of stages or stage pools, matched in order with the keys.
+            :return: A list of request objects, in the same order as the keys.
+            """
+            elem_size = self._queue.elem_size()
+            reqs = []
+            packed = []
+            size = 0
+            try:
+                for key, stage in zip(keys, stages):
+                    try:
+                        req, details = self._make_request(key, stage, block=False)
+                    except queue.Empty:
+                        # The stage pool is empty. Its stages may be held by the requests gathered so far, which can
+                        # only free them once they are processed, so those requests are queued before waiting.
+                        if len(packed) > 0:
+                            self._put_queue_packed(packed)
+                            packed = []
+                            size = 0
+                        req, details = self._make_request(key, stage)
+                    reqs.append(req)
+                    data = request_packer.pack_ext(details)
+                    # Queue the requests gathered so far once the next would not fit alongside them into an element
+                    # of the queue, so that they do not spill into its side channel. Queueing them as they are
+                    # gathered also lets their stages be freed while the remaining requests are made. Up to 5 bytes
+                    # are allowed for the list header.
+                    if len(packed) > 0 and size + len(data) + 5 > elem_size:
+                        self._put_queue_packed(packed)
+                        packed = []
+                        size = 0
+                    packed.append(data)
+                    size += len(data)
+            finally:
+                # Requests that were made before any error are still queued, so that they can be fulfilled.
+                if len(packed) > 0:
+                    self._put_queue_packed(packed)
+            return reqs
+
+        def _make_request(self, key, stage, block=True):
+            """
+            Generate a request and register it as pending, without queueing it.
+            :param key: Operations created by a dataset proxy.
+            :param stage: A stage or stage pool in which the result will be stored.
+            :param block: If False, raise queue.Empty rather than waiting when no stage is available in a stage pool.
+            :return: A tuple of the request object and the RequestDetails object to be queued.
+            """
             if self._close.is_set():
                 raise RuntimeError("Attempt to request data from a closed reader.")
 
             # Acquire the stage. Note the stage variable is overwritten, as the stage argument may actually be
             # a stage pool.
-            stage, shm_buf = stage._acquire()
+            stage, shm_buf = stage._acquire(block)
 
             # Serialise the key into bytes.
-            keydata = request_packer.pack(key)
-            if self._queue.elem_size() < (len(keydata) + 50) and len(keydata) <= (shm_buf.size() - 4):
+            if isinstance(key, dataset_ops.OpBase):
+                keydata = key._pack(request_packer)
+            else:
+                keydata = request_packer.pack(key)
+            if self._queue.elem_size() < (len(keydata) + 50) and len(keydata) <= (shm_buf.size() - _keysize_struct.size):
                 # If the key is too large to be stored in the request queue shared memory, but small enough that it
                 # could be put into the stage, place it into the stage. This avoids passing it through the request
                 # queue side channel. Note that 50 is added to the key data size to conservatively account for the
-                # size of the RequestDetails object, and 4 is subtracted from the stage size to account for the size
-                # of the integer that needs to be stored alongside the key data.
+                # size of the RequestDetails object, and the size of the key size marker is subtracted from the stage size
+                # to account for the integer that needs to be stored alongside the key data.
                 key = None
             else:
                 key = keydata
             
             with self._open_reqs() as open_reqs:
-                req_id = self._next_req_id
+                if self._free_req_ids:
+                    req_id = self._free_req_ids.pop()
+                else:
+                    req_id = len(open_reqs)
+                    open_reqs.append(None)
                 details = request.RequestDetails(req_id, key, shm_buf)
                 
                 req = request.Request(details, stage)
                 open_reqs[req_id] = req
-                self._next_req_id += 1
 
             if key is None:
-                # If the key is to be stored in the stage.
+                # If the key is to be stored in the stage, it must be written before the request is queued. The
+                # buffer lock only guards against other threads of this process, so a read process could otherwise
+                # pick up the request and read the stage before the key is in it.
                 with shm_buf.get_direct() as buf:
-                    self._put_queue(details)
-                    buf[-4:] = struct.pack('@I', len(keydata)) # The last 4 bytes store the size of the key data.
+                    _keysize_struct.pack_into(buf, len(buf) - _keysize_struct.size, len(keydata))
                     buf[:len(keydata)] = keydata
-            else:
-                self._put_queue(details)
-            
-            return req
+
+            return req, details
 
         def close(self, wait=False):
             """
@@ -355,7 +500,7 @@ class Reader:
             stating that the reader has stopped.
             """
             self.close()
-            self._stop.set()
+            self._done.value = True
 
     def get_dataset(self, path):
         """
@@ -377,6 +522,16 @@ class Reader:
         """
         return self._core.request(key, stage)
 
+    def request_many(self, keys, stages):
+        """
+        Generate and queue a number of requests at once. This behaves as a call to request for each key and stage,
+        but the requests are passed to the background processes in batches, which is faster for many small requests.
+        :param keys: A sequence of operations created by dataset proxies.
+        :param stages: A sequence of stages or stage pools, matched in order with the keys.
+        :return: A list of request objects, in the same order as the keys.
+        """
+        return self._core.request_many(keys, stages)
+
     def close(self, wait=False):
         """
         Close the reader. After this point, no more requests can be made. Pending requests will still be fulfilled.
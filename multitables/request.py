@@ -22,6 +22,7 @@ class RequestDetails(msgpack_ext.MsgpackExtType):
         self.map_id = shm_buf.name
         self.size_nbytes = shm_buf.size_nbytes
 
+    __slots__ = ('req_id', 'key', 'size_nbytes', 'map_id')
     _pack_map = msgpack_ext.MsgpackExtType._pack_map + ['req_id', 'key', 'size_nbytes', 'map_id']
 msgpack_registry.register_class(RequestDetails)
 
@@ -37,7 +38,10 @@ class Request:
         """
         self._details = details
         self._stage = stage
-        self._ready = threading.Event()
+        # A plain lock, held until the request is fulfilled, is much cheaper to create than an event. Waiting on the
+        # request acquires and then immediately releases the lock.
+        self._ready = threading.Lock()
+        self._ready.acquire()
 
     def _notify(self, dtype, shape, e=None):
         """
@@ -48,7 +52,7 @@ class Request:
         """
         self._dtype, self._out_shape = dtype, shape
         self._exception = e
-        self._ready.set()
+        self._ready.release()
         
     @contextmanager
     def get_unsafe(self):
@@ -62,7 +66,8 @@ class Request:
         when the associated stage is re-used for another request. It is recommended to use a safer access method,
         or immediately delete or set to None the local variable bound to the yielded reference after use.
         """
-        self._ready.wait()
+        with self._ready:
+            pass
         with self._stage._release() as get_ary:
             if self._exception is not None:
                 raise signals.CreateSubprocessException(self._exception)
@@ -112,26 +117,57 @@ class RequestPool:
     """ A helper class for managing a pool of requests. """
 
     def __init__(self):
+        # The deque is appended to and popped from without holding the condition variable, as these operations are
+        # atomic. The condition variable is only used by threads that find the pool empty and need to wait.
         self._queue = collections.deque()
         self._cvar = threading.Condition()
+        # The number of threads blocked in next(), so that adding to the pool only signals when necessary.
+        self._n_waiting = 0
+
+    def _wake(self):
+        """
+        Wake a single thread waiting in next(), if there is one.
+        """
+        # A waiting thread increments the count before checking if the pool is empty, and an adding thread appends
+        # before checking the count, so one of the two always sees the other.
+        if self._n_waiting > 0:
+            with self._cvar:
+                self._cvar.notify()
 
     def add(self, req):
         """
         Add a request to the pool.
         :param req: An object instance that should be place in the pool.
         """
-        with self._cvar:
-            self._queue.append(req)
-            self._cvar.notify()
+        self._queue.append(req)
+        self._wake()
 
-    def next(self):
+    def next(self, keep=None):
         """
         Get the next object in the pool. Blocks until an object is available.
+        :param keep: Optional sentinel object. If the next object is the sentinel, it is returned but left in the
+            pool, so that every later call also returns it without a separate add.
         :return: The next object in the pool.
         """
-        with self._cvar:
-            while len(self._queue) == 0:
-                self._cvar.wait()
-            return self._queue.popleft()
-
-
+        try:
+            item = self._queue.popleft()
+        except IndexError:
+            with self._cvar:
+                self._n_waiting += 1
+                try:
+                    while True:
+                        # Other threads may take objects from the pool without the condition variable, so the
+                        # pool is checked by attempting to take from it.
+                        try:
+                            item = self._queue.popleft()
+                            break
+                        except IndexError:
+                            self._cvar.wait()
+                finally:
+                    self._n_waiting -= 1
+        if keep is not None and item is keep:
+            # Put the sentinel back at the front of the pool, and pass it on to any thread that found the pool empty
+            # while it was out.
+            self._queue.appendleft(keep)
+            self._wake()
+        return item
@@ -4,10 +4,14 @@
 # of the MIT license.  See the LICENSE.txt file for details.
 
 import os
+import binascii
 import threading
 from contextlib import contextmanager
 import numpy as np
 
+import sys
+_PYTHON3 = sys.version_info > (3, 0)
+
 from . import numpy_utils
 
 if os.name == "nt":
@@ -15,23 +19,25 @@ if os.name == "nt":
 else:
     _USE_POSIX = True
 
-# Python 3.8 will eventually have an inbuilt library to handle all of this, but it is currently 
-# not usable due to the resource tracker interfering with memory management.
-# try:
-#     # Use the provided shared memory facilities if available.
-#     import multiprocessing.shared_memory
-#     _USE_INTERNAL = True
-# except ImportError:
+# Python 3.8 has an inbuilt library to handle all of this, but before Python 3.13 it is not usable due to
+# the resource tracker interfering with memory management. From Python 3.13, tracking can be disabled.
+try:
+    # Use the provided shared memory facilities if available.
+    import multiprocessing.shared_memory
+    _USE_INTERNAL = sys.version_info >= (3, 13)
+except ImportError:
+    _USE_INTERNAL = False
 
-_USE_INTERNAL = False
 # Otherwise, revert to basic shared memory implementation.
 # The older shared memory API provided by multiprocessing is not appropriate as it can only use anonymous memory.
 import mmap
 
+# Segments of at least the size of a huge page are advised to use huge pages.
+_HUGE_PAGE_NBYTES = 2*1024*1024
+
 def _make_map_id():
     """ Create a random string identifier for a shared memory block. """
-    import base64, random, struct
-    return b'/' + base64.urlsafe_b64encode(struct.pack('<Q', random.getrandbits(64)))
+    return b'/mt' + binascii.hexlify(os.urandom(8))
 
 if _USE_POSIX:
     import ctypes
@@ -69,9 +75,6 @@ else:
     # _winapi is just required for handling errors.
     import _winapi
 
-import sys
-_PYTHON3 = sys.version_info > (3, 0)
-
 class SharedMemoryError(Exception):
     pass
 
@@ -79,13 +82,15 @@ class SharedMemoryError(Exception):
 class SharedBuffer:
     """ A class for creating a segment of named shared memory. """
 
-    def __init__(self, map_id, size_nbytes):
+    def __init__(self, map_id, size_nbytes, prefault=False):
         """ 
         Create a segment of shared memory with an automatically generated name.
         Or open an already created segment with the provided name.
 
         :param map_id: The name of the shared memory. Should be None if a new segment is to be created.
         :param size_nbytes: The size, in bytes, of the segment.
+        :param prefault: If True, a newly created segment has all of its pages allocated immediately, rather than
+            one at a time when they are first written.
         """
         # This flag is used to signal if the shared memory has been unlinked by the owning process.
         self._flag = None
@@ -97,11 +102,12 @@ class SharedBuffer:
             # The master handles the lifetime of the memory, and unlinks it when it is no longer needed.
             master = (map_id is None)
             if _USE_INTERNAL:
+                # The lifetime of the memory is handled by the master, so the resource tracker is disabled.
                 if master:
-                    self._raw_mem = multiprocessing.shared_memory.SharedMemory(create=True, size=alloc_nbytes)
+                    self._raw_mem = multiprocessing.shared_memory.SharedMemory(create=True, size=alloc_nbytes, track=False)
                     map_id = self._raw_mem.name
                 else:
-                    self._raw_mem = multiprocessing.shared_memory.SharedMemory(name=map_id, size=alloc_nbytes)
+                    self._raw_mem = multiprocessing.shared_memory.SharedMemory(name=map_id, size=alloc_nbytes, track=False)
                 
                 def unlink():
                     self._raw_mem.unlink()
@@ -109,9 +115,12 @@ class SharedBuffer:
                 def close():
                     self._raw_mem.close()
                 
-                self._buf = self._raw_mem.buf
+                # The segment may have been rounded up to a whole number of pages, so only expose the requested size.
+                self._buf = self._raw_mem.buf[:alloc_nbytes]
                 def release_buf():
-                    pass # Releasing the buffer is handled by multiprocessing.
+                    if self._buf is not None:
+                        self._buf.release()
+                        self._buf = None
             else:
                 if _USE_POSIX:
                     if master:
@@ -146,6 +155,14 @@ class SharedBuffer:
                         unlink()
                         raise
 
+                    if alloc_nbytes >= _HUGE_PAGE_NBYTES and hasattr(mmap, 'MADV_HUGEPAGE'):
+                        # Ask for large segments to be backed by huge pages, reducing TLB misses when a whole result
+                        # is read. This is only advice, and kernels without huge page support may refuse it.
+                        try:
+                            self._mmap.madvise(mmap.MADV_HUGEPAGE)
+                        except OSError:
+                            pass
+
                     def close():
                         if self._mmap is not None:
                             self._mmap.close()
@@ -185,10 +202,15 @@ class SharedBuffer:
                             self._buf.release()
                         self._buf = None
 
-            # The flag is the first byte of the memory
-            self._flag = self._buf[:1]
-            # The actual exposed buffer is the rest of the memory.
-            self._ary = self._buf[1:]
+            if master and prefault:
+                # Touch one byte in every page, so that the pages are faulted in here in bulk.
+                np.frombuffer(self._buf, dtype=np.uint8)[::mmap.PAGESIZE] = 0
+
+            # The actual exposed buffer is the start of the memory, so that it is aligned to the page boundary of the
+            # segment, and any numpy array placed in it is suitably aligned for its datatype.
+            self._ary = self._buf[:size_nbytes]
+            # The flag is the last byte of the memory.
+            self._flag = self._buf[size_nbytes:size_nbytes+1]
 
             def release():
                 # Release these pointers when the buffer is closed.
@@ -271,15 +293,26 @@ class SharedBuffer:
         if self.size() < nbytes:
             raise SharedMemoryError("Stage is smaller than requested array: {} < {}".format(self.size(), nbytes))
         with self._lock:
-            yield np.array(self._ary[:nbytes], copy=False).view(dtype).reshape(shape)
+            # The array is created directly over the start of the buffer, rather than through a byte view that is
+            # then reinterpreted and reshaped.
+            yield np.ndarray(shape, dtype=dtype, buffer=self._ary)
 
     def set_to(self, value):
         """
         Set the buffer to the given numpy array. The array may be smaller than the size of the buffer.
         :param value: A numpy ndarray with the desired values.
         """
-        with self.asarray_direct(value.dtype, value.shape) as ary:
-            ary[...] = value
+        value = np.asarray(value)
+        if _PYTHON3 and value.flags.c_contiguous:
+            # A contiguous array can be copied in as raw bytes, skipping the construction of an ndarray interface
+            # to the buffer and the general numpy assignment.
+            if self.size() < value.nbytes:
+                raise SharedMemoryError("Stage is smaller than requested array: {} < {}".format(self.size(), value.nbytes))
+            with self._lock:
+                self._ary[:value.nbytes] = value.reshape(-1).view(np.uint8)
+        else:
+            with self.asarray_direct(value.dtype, value.shape) as ary:
+                ary[...] = value
 
     def is_closed(self):
         """
@@ -4,9 +4,8 @@
 # of the MIT license.  See the LICENSE.txt file for details.
 
 import multiprocessing
+import multiprocessing.sharedctypes
 import threading
-import time
-import struct
 import collections
 from contextlib import contextmanager
 
@@ -18,36 +17,8 @@ if _PYTHON3:
 else:
     import Queue as queue
 
-def HeartbeatCondition(heartbeat, *args, **kw_args):
-    """
-    The default multiprocessing implementation of a condition variable has a performance regression when
-    waiting on the variable with a timeout. As not all platforms implement a condition variable with a
-    timeout, the default implementation runs a spin-lock on the variable, sleeping for increasing periods
-    of time. This results in poor performance.
-
-    This function defines a condition variable that is periodically woken up by a heartbeat notificaiton.
-    This allows for a timeout-like behaviour while avoiding a spin-lock on the variable. This approach 
-    effectively trades better wake performance for increased variability in when the timout actually occurs
-    and spirious wake-ups, which is acceptable in this scenario.
-    
-    :param heartbeat: The period at which the heartbeat occurs, this should be reasonably close to the desired timeout period.
-    :param args: Positional parameters which are forwarded to the underlying condition variable.
-    :param kw_args: Keyword parameters which are forwarded to the underlting condition variable.
-    :return: The condition variable with a heartbeat thread attached.
-    """
-    cvar = multiprocessing.Condition(*args, **kw_args)
-
-    def heart():
-        while True:
-            with cvar:
-                cvar.notify_all()
-            time.sleep(heartbeat)
-    
-    timeout_thread = threading.Thread(target=heart)
-    timeout_thread.daemon=True
-    timeout_thread.start()
-    cvar.__heartbeat_thread = timeout_thread
-    return cvar
+# Size marker for queue items that have been routed through the side-channel.
+_SIDE_CHANNEL = -1
 
 class SharedQueue:
     """
@@ -68,38 +39,31 @@ class SharedQueue:
         """
         self._elem_size = elem_size
         self._queue_len = queue_len
-
-        import multiprocessing.sharedctypes
-        # This lock controls access to the shared memory.
-        self._vals_lock = multiprocessing.Lock()
-        # Separate condition variables are used for putting and getting elements from the queue, which share the same lock,
-        # as they encode different signals for the same resource.
-        self._cvar_putters = multiprocessing.Condition(self._vals_lock)
-        self._cvar_getters = HeartbeatCondition(0.1, self._vals_lock)
-        
-        # Define the size in bytes of the 'size' value, which is written into the memory to store how long the input is.
-        self._size_format = '@L'
-        self._size_t_size = len(struct.pack(self._size_format, 0))
-        self._size_offset = self._elem_size
-
-        # Define the size in bytes of the 'flag' value, which signifies when an input has been routed through the side-channel.
-        self._flag_format = '@?'
-        self._flag_size = len(struct.pack(self._flag_format, False))
-        self._flag_offset = self._size_offset + self._size_t_size
-
-        # Define the size of the metadata.
-        self._meta_size = self._flag_size + self._size_t_size
-        # Define the size of the 'block', which is the metadata-element data pair.
-        self._block_size = self._meta_size + elem_size
+        # The ring holds a power of two number of elements, so that its indices wrap with a mask rather than a
+        # modulo. Only queue_len elements are ever in use, as that is the number of free slots.
+        n_elems = 1 << (queue_len - 1).bit_length()
+        self._mask = n_elems - 1
+
+        # Putters and getters work at opposite ends of the queue, so each end has its own lock. The semaphores below
+        # guarantee that the two ends never meet on the same element, and so a put never waits for a get to finish.
+        self._head_lock = multiprocessing.Lock()
+        self._tail_lock = multiprocessing.Lock()
+        # Separate semaphores count the free and the occupied elements of the queue. Putters wait on the former,
+        # and getters on the latter. Unlike a condition variable, waiting on a semaphore with a timeout does not
+        # degrade into a spin-lock, and a put only wakes a single getter.
+        self._free_slots = multiprocessing.Semaphore(queue_len)
+        self._used_slots = multiprocessing.Semaphore(0)
 
         # A shared array is used to store items in the queue
-        self._sary = multiprocessing.sharedctypes.RawArray('b', self._block_size*queue_len)
+        self._sary = multiprocessing.sharedctypes.RawArray('b', elem_size*n_elems)
         self._vals = None
+        # The size of each item in the queue is stored in a separate shared array, where it can be read and written
+        # with plain indexing. A size of _SIDE_CHANNEL signifies that the item has been routed through the side-channel.
+        self._sizes = multiprocessing.sharedctypes.RawArray('l', n_elems)
 
-        # tail is the next item to be read from the queue
+        # head is the next element to be written to, and tail is the next item to be read from the queue.
+        self._head = multiprocessing.sharedctypes.RawValue('l', 0)
         self._tail = multiprocessing.sharedctypes.RawValue('l', 0)
-        # size is the current number of items in the queue. head = tail + size
-        self._size = multiprocessing.sharedctypes.RawValue('l', 0)
 
         self._side_channel = multiprocessing.Queue()
 
@@ -187,46 +151,38 @@ class SharedQueue:
 
     def _place_block(self, bytes, flag):
         """
-        Internal method for actually writing to the shared memory. Assumes the condition variable is taken.
+        Internal method for actually writing to the shared memory. Assumes the head lock is taken.
         """
-        assert(self._size.value < self._queue_len)
-        # Calculate where the head of the queue is, wrapping around the end of the memory.
-        head = (self._tail.value + self._size.value) % self._queue_len
-        # Find the offset in bytes where the head of the queue is.
-        ptr = head * self._block_size
-        # Grab the next block as 
-        block_m = self._vals[ptr:ptr+self._block_size]
-
-        # Always write the value of the flag.
-        block_m[self._flag_offset:self._flag_offset+self._flag_size] = struct.pack(self._flag_format, flag)
+        head = self._head.value
 
-        # If the flag is not True, actually write the bytes as well.
-        if not flag:
-            # Write the bytes to the start of the block.
-            block_m[:len(bytes)] = bytes
-            # The input size (and the flag) are placed at the end of the block.
-            block_m[self._size_offset:self._size_offset+self._size_t_size] = struct.pack(self._size_format, len(bytes))
+        if flag:
+            # Only mark the input as routed through the side-channel.
+            self._sizes[head] = _SIDE_CHANNEL
+        else:
+            # Otherwise, write the bytes to the element at the head, and record their size.
+            ptr = head * self._elem_size
+            self._vals[ptr:ptr+len(bytes)] = bytes
+            self._sizes[head] = len(bytes)
         
-        # Increase the size of the queue.
-        self._size.value += 1
-        self._cvar_getters.notify()
+        # Advance the head, wrapping around the end of the memory.
+        self._head.value = (head + 1) & self._mask
 
     def _put_shared(self, flag, block, bytes=b''):
         """
         Internal method for managing writing to the shared memory.
         """
         assert(len(bytes) <= self._elem_size)
-        with self._vals_lock:
-            while self._size.value >= self._queue_len: # Only terminate this loop once there's room in the queue.
-                assert(self._size.value == self._queue_len)
-                if not block:
-                    # If a non-blocking put is requested, terminate the method now and report failure.
-                    return False
-                self._cvar_putters.wait()
+        # Only continue once there's room in the queue.
+        if not self._free_slots.acquire(block):
+            # If a non-blocking put is requested, terminate the method now and report failure.
+            return False
 
-            # At this point, there is room in the queue, so actually write to memory and report success.
+        # At this point, there is room in the queue, so actually write to memory and report success.
+        with self._head_lock:
             self._place_block(bytes, flag)
-            return True
+        # Wake up a single getter.
+        self._used_slots.release()
+        return True
     
     def put_async(self, bytes):
         """
@@ -263,48 +219,97 @@ class SharedQueue:
         if self._vals is None:
             self._init_delayed()
         
-        # If a timeout is requested, start the clock.
-        if timeout is not None:
-            t_start = time.time()
-        
-        with self._vals_lock:
-            # Wait while the queue is empty.
-            while self._size.value <= 0:
-                assert(self._size.value == 0)
-                # If non-blocking get is requested, raise the Empty exception.
-                # If blocking get is requested with timeout, check if timeout has expired and if so, raise the Empty exception.
-                if (not block) or (timeout is not None and time.time() - t_start >= timeout):
-                    raise queue.Empty()
+        # Wait while the queue is empty.
+        # If non-blocking get is requested, or the timeout expires, raise the Empty exception.
+        if not self._used_slots.acquire(block, timeout):
+            raise queue.Empty()
+
+        # Whether the element at the tail was removed from the queue.
+        removed = False
+        try:
+            with self._tail_lock:
+                tail = self._tail.value
+                rsize = self._sizes[tail]
+
+                if rsize == _SIDE_CHANNEL:
+                    # If a flag was raised, attempt to get the value from the side-channel.
+                    rval = self._side_channel.get(block=block)
+                    # If self._side_channel.get is called with block=False, and the value hasn't made it through the
+                    # side-channel yet, then a queue.Empty exception is raised and allowed to propagate back.
+                    # In this case, the tail of the queue will not be updated, so the next get request will
+                    # return to this exact situation again, until the value is available.
+                else:
+                    # Otherwise, pull it from the memory.
+                    ptr = tail * self._elem_size
+                    rval = self._vals[ptr:ptr+rsize]
+                removed = True
+                try:
+                    yield rval
+                finally:
+                    # If the value was yielded, make sure to remove the element from the queue.
+                    self._tail.value = (tail + 1) & self._mask
+        finally:
+            if removed:
+                # Wake up a single putter.
+                self._free_slots.release()
+            else:
+                # The element was not removed from the queue, so hand it back to the other getters.
+                self._used_slots.release()
+
+    @contextmanager
+    def get_direct_batch(self, max_n, block=True, timeout=None):
+        """
+        Get up to max_n values from the queue at once, with direct access to the underlying memory controlled by a
+        context manager. Only the first value is waited for, any others are taken only if they are already in the
+        queue. If the queue is empty, a queue.Empty exception is raised.
 
-                self._cvar_getters.wait()
- 
-            #while True:
-            #    if self._size.value > 0:
-            # Find the offset in bytes of where the tail is located in memory.
-            ptr = self._tail.value * self._block_size
-            # Get the tail of the queue as a memoryview.
-            block_m = self._vals[ptr:ptr+self._block_size]
+        :param max_n: The maximum number of values to get.
+        :param block: Whether to block and wait for the next value to appear in the queue.
+        :param timeout: In conjunction with block=True, how long to wait before raising queue.Empty.
+        :return: A context manager that yields a list of memoryviews into the underlying memory.
+        """
+        # Perform the delayed initialisation if necessary.
+        if self._vals is None:
+            self._init_delayed()
 
-            flag, = struct.unpack(self._flag_format, block_m[self._flag_offset:self._flag_offset+self._flag_size])
+        # Wait while the queue is empty.
+        # If non-blocking get is requested, or the timeout expires, raise the Empty exception.
+        if not self._used_slots.acquire(block, timeout):
+            raise queue.Empty()
+        # Claim any further values that are already waiting, without blocking.
+        n = 1
+        while n < max_n and self._used_slots.acquire(False):
+            n += 1
 
-            if flag:
-                # If a flag was raised, attempt to get the value from the side-channel.
-                rval = self._side_channel.get(block=block)
-                # If self._side_channel.get is called with block=False, and the value hasn't made it through the
-                # side-channel yet, then a queue.Empty exception is raised and allowed to propagate back.
-                # In this case, the tail of the queue will not be updated, so the next get request will
-                # return to this exact situation again, until the value is available.
-            else:
-                # Otherwise, pull it from the memory.
-                # First get the size of the value from the metadata.
-                rsize, = struct.unpack(self._size_format, block_m[self._size_offset:self._size_offset+self._size_t_size])
-                # Then get the value itself.
-                rval = block_m[:rsize]
-        
-            try:
-                yield rval
-            finally:
-                # If the value was yielded, make sure to remove the element from the queue.
-                self._tail.value = (self._tail.value + 1) % self._queue_len
-                self._size.value -= 1
-                self._cvar_putters.notify()
\ No newline at end of file
+        rvals = []
+        try:
+            with self._tail_lock:
+                tail = self._tail.value
+                for i in range(n):
+                    idx = (tail + i) & self._mask
+                    rsize = self._sizes[idx]
+                    if rsize == _SIDE_CHANNEL:
+                        try:
+                            rval = self._side_channel.get(block=block)
+                        except queue.Empty:
+                            # As in get_direct, the element stays at the tail of the queue. If values were already
+                            # taken from the side-channel, the batch is cut short here rather than losing them.
+                            if len(rvals) == 0:
+                                raise
+                            break
+                    else:
+                        ptr = idx * self._elem_size
+                        rval = self._vals[ptr:ptr+rsize]
+                    rvals.append(rval)
+                try:
+                    yield rvals
+                finally:
+                    # Remove the yielded elements from the queue.
+                    self._tail.value = (tail + len(rvals)) & self._mask
+        finally:
+            # Wake up a putter for each removed element, and hand any elements that were not removed back to the
+            # other getters.
+            for _ in range(len(rvals)):
+                self._free_slots.release()
+            for _ in range(n - len(rvals)):
+                self._used_slots.release()
@@ -4,6 +4,7 @@
 # of the MIT license.  See the LICENSE.txt file for details.
 
 import threading
+import time
 from contextlib import contextmanager
 import collections
 
@@ -20,18 +21,20 @@ from . import shared_mem
 class Stage:
     """ Resource manager for an underlying shared buffer. """
 
-    def __init__(self, size_nbytes):
+    def __init__(self, size_nbytes, prefault=False):
         """
         Create a stage that can host a numpy array of at most size_nbytes bytes.
         :param size_nbytes: The size, in bytes, of the underlying shared buffer.
+        :param prefault: If True, the pages of the underlying shared buffer are allocated immediately.
         """
         self.size_nbytes = size_nbytes
-        self._shm_buf = shared_mem.SharedBuffer(map_id=None, size_nbytes=self.size_nbytes)
+        self._shm_buf = shared_mem.SharedBuffer(map_id=None, size_nbytes=self.size_nbytes, prefault=prefault)
         self._lock = threading.Lock()
 
-    def _acquire(self):
+    def _acquire(self, block=True):
         """
         Acquire the stage, locking it so that it cannot be acquired again until it is released.
+        :param block: Unused, a stage never waits to be acquired. Accepted for compatibility with stage pools.
         :return: A tuple, the first element is the stage that hosts the shared buffer, the second element
             is the underlying shared buffer.
         """
@@ -84,40 +87,48 @@ class StagePool:
             finally:
                 self._pool._return(self)
 
-    def __init__(self, dataset, stage_size, N_stages, timeout=None):
+    def __init__(self, dataset, stage_size, N_stages, timeout=None, prefault=False, dtype=None):
         """
         Create a stage pool based on a given dataset.
         :param dataset: Parent dataset that is used to calculate the size of the member stage elements.
         :stage_size: Size of each stage in the pool, this is passed to the constructor for the stage.
         :N_stages: The number of stages to be allocated in the pool.
         :timeout: Optional time out when attempting to acquire a stage from the pool.
+        :prefault: If True, the pages of each stage are allocated immediately.
+        :dtype: Optional datatype of the results the stages should hold, if it differs from that of the dataset.
         """
         self._stage_pool = collections.deque()
-        if timeout is None:
-            self._cvar = threading.Condition()
-        else:
-            from . import shared_queue
-            self._cvar = shared_queue.HeartbeatCondition(timeout)
+        # The pool is only shared between threads, so a thread condition variable is sufficient. Returning a stage
+        # wakes a single waiter, while a timed out waiter wakes itself.
+        self._cvar = threading.Condition()
         self._timeout = timeout
 
+        # All stages in the pool have the same size, so it is only calculated once.
+        stage_nbytes = dataset._stage_nbytes(stage_size, dtype)
         for _ in range(N_stages):
-            self._stage_pool.append(StagePool.StagePoolWrapper(dataset.create_stage(stage_size), self))
+            self._stage_pool.append(StagePool.StagePoolWrapper(Stage(stage_nbytes, prefault=prefault), self))
 
-    def _acquire(self):
+    def _acquire(self, block=True):
         """
         Acquire a stage, and its underlying shared memory, from the pool. This method blocks until either a
         stage is available, or the optional timeout (provided in the pool constructor) has expired. If the
         timeout expires, a queue.Empty exception is raised.
+        :param block: If False, raise queue.Empty immediately when no stage is available, rather than waiting.
         :return: A tuple, the first element is the acquired stage, the second element is its shared memory.
         """
         if self._timeout is not None:
-            import time
             start = time.time()
         with self._cvar:
             while len(self._stage_pool) == 0:
-                if self._timeout is not None and time.time() - start >= self._timeout:
+                if not block:
                     raise queue.Empty()
-                self._cvar.wait()
+                elif self._timeout is None:
+                    self._cvar.wait()
+                else:
+                    remaining = self._timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise queue.Empty()
+                    self._cvar.wait(remaining)
             return self._stage_pool.popleft()._acquire()
 
     def _return(self, stage):
@@ -4,6 +4,7 @@
 # of the MIT license.  See the LICENSE.txt file for details.
 
 import threading
+import warnings
 
 import sys
 _PYTHON3 = sys.version_info > (3, 0)
@@ -35,17 +36,24 @@ class Streamer:
         self._h5_kw_args = kw_args
         self._closed = threading.Event()
 
-    def __get_batch(self, path, length, field=None, last=False):
+    def __get_batch(self, path, length, field=None, last=False, align_chunks=False, h5_file=None):
         """
         Get a block of data from the node at path.
 
         :param path: The path to the node to read from.
         :param length: The length along the outer dimension to read.
         :param last: True if the remainder elements should be read.
+        :param align_chunks: True if the length should be rounded up to a whole number of chunks.
+        :param h5_file: An already open HDF5 file to read from. If omitted, the file is opened and closed here.
         :return: A copy of the requested block of data as a numpy array.
         """
-        import tables
-        h5_file = tables.open_file(self._filename, 'r')
+        if h5_file is None:
+            # PyTables is only imported where it is used, as multi-process access to HDF5 behaves better without a
+            # top level import.
+            import tables
+            with tables.open_file(self._filename, 'r', **self._h5_kw_args) as h5_file:
+                return self.__get_batch(path, length, field=field, last=last, align_chunks=align_chunks, h5_file=h5_file)
+
         h5_node = h5_file.get_node(path)
 
         node_shape = h5_node.shape
@@ -53,26 +61,32 @@ class Streamer:
         if node_shape[0] == 0:
             raise RuntimeError("Cannot read from empty dataset.")
 
+        chunk_shape = h5_node.chunkshape
+        if chunk_shape is not None and chunk_shape[0] == 0:
+            warnings.warn(("Outer dimension of chunk is zero {}. This shouldn't happen," + \
+                    " but multitables will assume this means there is no chunk information.").format(chunk_shape), RuntimeWarning)
+            chunk_shape = None
+
         # If the length isn't specified, then fall back to default values.
         if length is None:
-            chunk_shape = h5_node.chunkshape
-            if chunk_shape is not None and chunk_shape[0] == 0:
-                import warnings
-                warnings.warn(("Outer dimension of chunk is zero {}. This shouldn't happen," + \
-                        " but multitables will assume this means there is no chunk information.").format(chunk_shape), RuntimeWarning)
-                chunk_shape = None
+            if field is None:
+                row_nbytes = h5_node[0].nbytes
+            else:
+                row_nbytes = h5_node[0][field].nbytes
             # If the array isn't chunked, then try to make the block close to 128KB.
             if chunk_shape is None:
-                if field is None:
-                    row_nbytes = h5_node[0].nbytes
-                else:
-                    row_nbytes = h5_node[0][field].nbytes
                 default_length = 128*2**10//row_nbytes  # Divides by one row of the dataset.
-                length = min(h5_node.shape[0], default_length)
-            # If it is chunked, then use the chunkshape for best performance.
+            # If it is chunked, then use a whole number of chunks for best performance. Small chunks are grouped
+            # together until the block is at least 128KB, so that the per-block overhead is amortised.
             else:
                 chunk_length = chunk_shape[0]
-                length = chunk_length # try to aim for 3MB
+                n_chunks = max(1, -(-128*2**10//(chunk_length*row_nbytes)))
+                default_length = n_chunks*chunk_length
+            length = min(h5_node.shape[0], default_length)
+        elif align_chunks and chunk_shape is not None:
+            # Round the length up to a whole number of chunks, so that each chunk is only decoded by a single reader.
+            chunk_length = chunk_shape[0]
+            length = ((length + chunk_length - 1)//chunk_length)*chunk_length
 
         if last:
             example = h5_node[length*(len(h5_node)//length):]
@@ -81,10 +95,7 @@ class Streamer:
 
         if field is not None:
             example = example[field]
-        example = example.copy()
-
-        h5_file.close()
-        return example
+        return example.copy()
 
     def get_remainder(self, path, block_size):
         """
@@ -108,6 +119,7 @@ class Streamer:
             self._pool = request_pool
             self.stop = stop
             self.block_size = block_size
+            self._copy_executor = None
 
         def get(self):
             """
@@ -118,13 +130,30 @@ class Streamer:
 
             :return: A guard object that returns a reference to the element.
             """
-            next_req = self._pool.next()
+            next_req = self._pool.next(keep=QueueClosed)
             if next_req is QueueClosed:
-                self._pool.add(QueueClosed)
                 return next_req
             else:
                 return next_req.get_proxy()
 
+        def get_copy_async(self):
+            """
+            Get a copy of the next element from the queue of data, without waiting for the copy to be made. The copy
+            is made by a background thread, and the element is released back to the internal buffer as soon as the
+            copy is complete. This overlaps the copy with the caller's processing of the previous element.
+            This method blocks until data is available.
+
+            :return: A future that resolves to a copy of the element, or QueueClosed if the queue has finished.
+            """
+            next_req = self._pool.next(keep=QueueClosed)
+            if next_req is QueueClosed:
+                return next_req
+            if self._copy_executor is None:
+                import concurrent.futures
+                # A single thread keeps the copies, and the release of their elements, in queue order.
+                self._copy_executor = concurrent.futures.ThreadPoolExecutor(1)
+            return self._copy_executor.submit(next_req.get)
+
         def iter(self):
             """
             Convenience method for easy iteration over elements in the queue.
@@ -142,11 +171,101 @@ class Streamer:
         def close(self):
             """Signals to the background processes to stop, and closes the queue."""
             self.stop.set()
+            if self._copy_executor is not None:
+                self._copy_executor.shutdown(wait=False)
 
         def __del__(self):
             self.close()
 
-    def get_queue(self, path, n_procs=None, read_ahead=None, cyclic=False, block_size=None, ordered=False, field=None, remainder=False):
+    class RequestPaths:
+        """Records the dataset path of each pending request of a MultiQueue."""
+        def __init__(self):
+            self._paths = {}
+            self._lock = threading.Lock()
+            # An event for each request that a consumer is waiting on, so that recording a path only wakes the
+            # consumer waiting on that request.
+            self._waiting = {}
+
+        def add(self, req, path):
+            """
+            Record the dataset path of a request.
+            :param req: The request.
+            :param path: The path of the dataset the request reads from.
+            """
+            with self._lock:
+                self._paths[req] = path
+                ready = self._waiting.pop(req, None)
+            if ready is not None:
+                ready.set()
+
+        def pop(self, req):
+            """
+            Get the dataset path of a request, and forget it. A request can be fulfilled before its path has been
+            recorded, in which case this blocks until it is.
+            :param req: The request.
+            :return: The path of the dataset the request reads from.
+            """
+            with self._lock:
+                if req in self._paths:
+                    return self._paths.pop(req)
+                ready = self._waiting[req] = threading.Event()
+            ready.wait()
+            with self._lock:
+                return self._paths.pop(req)
+
+    class MultiQueue(Queue):
+        """Queue over several datasets, which also returns the path of the dataset each block belongs to."""
+        def __init__(self, request_pool, stop, block_sizes, req_paths):
+            """
+            :param block_sizes: A dictionary of the block size for each dataset path.
+            :param req_paths: The RequestPaths that records the dataset path of each pending request.
+            """
+            super(Streamer.MultiQueue, self).__init__(request_pool, stop, None)
+            self.block_sizes = block_sizes
+            self._req_paths = req_paths
+
+        def get(self):
+            """
+            Get the next element from the queue of data. See Queue.get.
+
+            :return: A tuple of the dataset path and a guard object that returns a reference to the element, or
+                QueueClosed once all datasets have been read.
+            """
+            next_req = self._pool.next(keep=QueueClosed)
+            if next_req is QueueClosed:
+                return next_req
+            return self._req_paths.pop(next_req), next_req.get_proxy()
+
+        def get_copy_async(self):
+            """
+            Get a copy of the next element from the queue of data, without waiting for the copy to be made.
+            See Queue.get_copy_async.
+
+            :return: A tuple of the dataset path and a future that resolves to a copy of the element, or
+                QueueClosed once all datasets have been read.
+            """
+            next_req = self._pool.next(keep=QueueClosed)
+            if next_req is QueueClosed:
+                return next_req
+            if self._copy_executor is None:
+                import concurrent.futures
+                self._copy_executor = concurrent.futures.ThreadPoolExecutor(1)
+            return self._req_paths.pop(next_req), self._copy_executor.submit(next_req.get)
+
+        def iter(self):
+            """
+            Convenience method for easy iteration over elements in the queue.
+
+            :return: An iterator over tuples of the dataset path and the guard for each element.
+            """
+            while True:
+                item = self.get()
+                if item is QueueClosed:
+                    break
+                else:
+                    yield item
+
+    def get_queue(self, path, n_procs=None, read_ahead=None, cyclic=False, block_size=None, ordered=False, field=None, remainder=False, align_chunks=False, memory_budget=2*2**30, dtype=None, affinity=None):
         """
         Get a queue that allows direct access to the internal buffer. If the dataset to be read is chunked, the
         block_size should be a multiple of the chunk size to maximise performance. In this case it is best to leave it
@@ -157,19 +276,29 @@ class Streamer:
 
         :param path: The HDF5 path to the dataset that should be read.
         :param n_procs: The number of background processes used to read the datset in parallel.
-        :param read_ahead: The number of blocks to allocate in the internal buffer.
+        :param read_ahead: The number of blocks to allocate in the internal buffer. Defaults to twice the number of
+            processes plus one, limited by the memory_budget.
         :param cyclic: True if the queue should wrap at the end of the dataset.
         :param block_size: The size along the outer dimension of the blocks to be read. Defaults to a multiple of
             the chunk size, or to a 128KB sized block if the dataset is not chunked.
         :param ordered: Force the reader return data in on-disk order. May result in performance penalty.
         :param field: The field or column name to read. If omitted, all fields/columns are read.
         :param remainder: Also return the remainder elements, these will be returned as array smaller than the block size.
+        :param align_chunks: Round the given block_size up to a multiple of the chunk size, if the dataset is chunked.
+            This ensures that each compressed chunk is only decoded once.
+        :param memory_budget: The size in bytes that the internal buffer should aim to stay within when the read_ahead
+            is chosen automatically. At least one block per process, plus one, is always allocated. Defaults to 2GB.
+        :param dtype: Cast the blocks to this datatype in the background processes. A narrower datatype reduces the
+            size of the internal buffer, and the amount of data that is copied out of it.
+        :param affinity: An optional list of CPU numbers to pin the background processes to. See Reader.
         :return: A queue object that allows access to the internal buffer.
         """
         # Get a block_size length of elements from the dataset to serve as a template for creating the buffer.
         # If block_size=None, then get_batch calculates an appropriate block size.
-        example = self.__get_batch(path, block_size)
+        example = self.__get_batch(path, block_size, field=field, align_chunks=align_chunks)
         block_size = example.shape[0]
+        if dtype is not None:
+            example = example.astype(dtype)
 
         if n_procs is None:
             n_procs = 4
@@ -177,9 +306,24 @@ class Streamer:
         if read_ahead is None:
             # 2x No. of processes for writing, 1 extra for reading.
             read_ahead = 2*n_procs + 1
+            # Large blocks can make the buffer exceed the available memory, so limit the read ahead to the budget.
+            max_read_ahead = max(n_procs + 1, memory_budget//max(example.nbytes, 1))
+            if read_ahead > max_read_ahead:
+                if example.nbytes > memory_budget:
+                    warnings.warn(("A single block of {} bytes exceeds the memory budget of {} bytes," + \
+                        " consider a smaller block_size.").format(example.nbytes, memory_budget), RuntimeWarning)
+                else:
+                    warnings.warn(("Limiting read_ahead to {} blocks to stay within the memory budget of {} bytes.")
+                        .format(max_read_ahead, memory_budget), RuntimeWarning)
+                read_ahead = max_read_ahead
         if read_ahead == 0:
             raise RuntimeError("The read_ahead parameter should be a strictly positive number or None.")
 
+        if ordered and n_procs == 1:
+            # A single process fulfils the requests in the order they are made, so the blocks already become
+            # available in on-disk order.
+            ordered = False
+
         request_pool = request.RequestPool()
         if ordered:
             def notify(req):
@@ -188,37 +332,53 @@ class Streamer:
             def notify(req):
                 request_pool.add(req)
         
-        self._dataset_reader = reader.Reader(self._filename, n_procs, notify=notify, **self._h5_kw_args)
+        self._dataset_reader = reader.Reader(self._filename, n_procs, notify=notify, affinity=affinity, **self._h5_kw_args)
 
         dataset = self._dataset_reader.get_dataset(path)
 
-        stage_pool = stage.StagePool(dataset, block_size, read_ahead, timeout=0.1)
+        # The stages are sized to hold one block of the requested field and datatype. They are reused for the
+        # lifetime of the queue, so their memory is allocated up front.
+        stage_pool = stage.StagePool(dataset, example.shape, read_ahead, timeout=0.1, prefault=True, dtype=example.dtype)
 
         self._stop = threading.Event()
         
+        n_rows = dataset.shape[0]
+        # Bind the read method once, it creates the slice ops without going through the general indexing logic.
+        if field is None:
+            read = dataset.read
+        else:
+            def read(start, stop):
+                return dataset.read(start, stop, field=field)
+
         def request_spool():
             i = 0
             try:
                 while not self._stop.is_set() and not self._closed.is_set():
                     start_idx, stop_idx = i, i + block_size
-                    if stop_idx > dataset.shape[0]:
+                    if stop_idx > n_rows:
                         if cyclic:
-                            split_idx = dataset.shape[0]
-                            stop_idx = block_size - (split_idx - start_idx)
-                            op = dataset_ops.JoinedSlicesOp(path, field, start_idx, split_idx, None, 0, stop_idx, None)
+                            stop_idx = block_size - (n_rows - start_idx)
+                            op = dataset_ops.JoinedSlicesOp(path, field, start_idx, n_rows, None, 0, stop_idx, None)
                         else:
-                            stop_idx = dataset.shape[0]
+                            stop_idx = n_rows
                             if remainder and start_idx < stop_idx:
-                                op = dataset[start_idx:stop_idx]
+                                op = read(start_idx, stop_idx)
                             else:
                                 break
                     else:
-                        op = dataset[start_idx:stop_idx]
-                    try:
-                        req = self._dataset_reader.request(op, stage_pool)
-                    except queue.Empty:
-                        # Raised when stage pool is empty
-                        continue
+                        op = read(start_idx, stop_idx)
+                    if dtype is not None:
+                        op = op.astype(dtype)
+                    # The op is built once per block, and only the request is retried while the stage pool is empty.
+                    req = None
+                    while req is None and not self._stop.is_set() and not self._closed.is_set():
+                        try:
+                            req = self._dataset_reader.request(op, stage_pool)
+                        except queue.Empty:
+                            # Raised when stage pool is empty
+                            pass
+                    if req is None:
+                        break
                     if ordered:
                         request_pool.add(req)
                     i = stop_idx
@@ -233,7 +393,133 @@ class Streamer:
                     
         return Streamer.Queue(request_pool, self._stop, block_size)
 
-    def get_generator(self, path, n_procs=None, read_ahead=None, cyclic=False, block_size=None, ordered=False, field=None, remainder=True):
+    def get_queue_multi(self, paths, n_procs=None, read_ahead=None, block_size=None, ordered=False, field=None, remainder=False, dtype=None, affinity=None):
+        """
+        Get a queue that reads several datasets in turn, sharing one set of background processes and one internal
+        buffer between them. This avoids launching processes and opening the file again for each dataset, which
+        dominates when there are many small datasets. The datasets are not read cyclically. Each element of the queue
+        is a tuple of the path of the dataset and a guard object for the block.
+        See the get_queue method for documentation of the other parameters.
+
+        :param paths: A list of HDF5 paths to the datasets that should be read.
+        :param block_size: The block size for every dataset. Defaults to a separate block size for each dataset,
+            chosen as in get_queue.
+        :param ordered: Force the reader to return data in the order of the paths, and in on-disk order within each
+            dataset.
+        :return: A queue object that allows access to the internal buffer.
+        """
+        paths = list(paths)
+        if len(paths) == 0:
+            raise RuntimeError("At least one dataset path is required.")
+
+        block_sizes = {}
+        largest = None
+        # The file is opened once to size all the datasets, rather than once per dataset.
+        import tables
+        with tables.open_file(self._filename, 'r', **self._h5_kw_args) as h5_file:
+            for path in paths:
+                example = self.__get_batch(path, block_size, field=field, h5_file=h5_file)
+                block_sizes[path] = example.shape[0]
+                if dtype is not None:
+                    example = example.astype(dtype)
+                if largest is None or example.nbytes > largest[1].nbytes:
+                    largest = path, example
+
+        if n_procs is None:
+            n_procs = 4
+
+        if read_ahead is None:
+            read_ahead = 2*n_procs + 1
+        if read_ahead == 0:
+            raise RuntimeError("The read_ahead parameter should be a strictly positive number or None.")
+
+        if ordered and n_procs == 1:
+            ordered = False
+
+        request_pool = request.RequestPool()
+        if ordered:
+            def notify(req):
+                pass
+        else:
+            def notify(req):
+                request_pool.add(req)
+
+        self._dataset_reader = reader.Reader(self._filename, n_procs, notify=notify, affinity=affinity, **self._h5_kw_args)
+
+        datasets = [ self._dataset_reader.get_dataset(path) for path in paths ]
+
+        # The stages are shared between all the datasets, so they are sized to hold the largest block.
+        largest_path, largest_example = largest
+        stage_pool = stage.StagePool(datasets[paths.index(largest_path)], largest_example.shape, read_ahead,
+            timeout=0.1, prefault=True, dtype=largest_example.dtype)
+
+        self._stop = threading.Event()
+
+        req_paths = Streamer.RequestPaths()
+
+        def request_spool():
+            try:
+                for path, dataset in zip(paths, datasets):
+                    n_rows, path_block_size = dataset.shape[0], block_sizes[path]
+                    for start_idx in range(0, n_rows, path_block_size):
+                        stop_idx = start_idx + path_block_size
+                        if stop_idx > n_rows:
+                            if not remainder:
+                                break
+                            stop_idx = n_rows
+                        if field is None:
+                            op = dataset.read(start_idx, stop_idx)
+                        else:
+                            op = dataset.read(start_idx, stop_idx, field=field)
+                        if dtype is not None:
+                            op = op.astype(dtype)
+                        req = None
+                        while req is None and not self._stop.is_set() and not self._closed.is_set():
+                            try:
+                                req = self._dataset_reader.request(op, stage_pool)
+                            except queue.Empty:
+                                # Raised when stage pool is empty
+                                pass
+                        if req is None:
+                            return
+                        req_paths.add(req, path)
+                        if ordered:
+                            request_pool.add(req)
+            finally:
+                if ordered:
+                    request_pool.add(QueueClosed)
+                self._dataset_reader.close()
+
+        self._request_thread = threading.Thread(target=request_spool)
+        self._request_thread.start()
+
+        return Streamer.MultiQueue(request_pool, self._stop, block_sizes, req_paths)
+
+    def get_batch_generator(self, path, n_procs=None, read_ahead=None, cyclic=False, block_size=None, ordered=False, field=None, remainder=True, align_chunks=False, memory_budget=2*2**30, dtype=None, affinity=None):
+        """
+        Get a generator that allows convenient access to the streamed data.
+        Elements from the dataset are returned from the generator one block at a time, so that the rows of each block
+        can be processed together.
+        Unlike the direct access queue, this generator also returns the remainder elements.
+        Additional arguments are forwarded to get_queue.
+        See the get_queue method for documentation of these parameters.
+
+        :param path:
+        :return: A generator that iterates over copies of the blocks in the dataset.
+        """
+        q = self.get_queue(path=path, n_procs=n_procs, read_ahead=read_ahead, cyclic=cyclic, block_size=block_size, ordered=ordered, field=field, remainder=remainder, align_chunks=align_chunks, memory_budget=memory_budget, dtype=dtype, affinity=affinity)
+
+        try:
+            for guard in q.iter():
+                with guard as batch:
+                    batch_copy = batch.copy()
+
+                yield batch_copy
+
+        finally:
+            q.close()
+
+    def get_generator(self, path, n_procs=None, read_ahead=None, cyclic=False, block_size=None, ordered=False, field=None, remainder=True, align_chunks=False, memory_budget=2*2**30, dtype=None, affinity=None, copy=True, out=None):
         """
         Get a generator that allows convenient access to the streamed data.
         Elements from the dataset are returned from the generator one row at a time.
@@ -242,18 +528,43 @@ class Streamer:
         See the get_queue method for documentation of these parameters.
 
         :param path:
+        :param copy: If True (the default), the rows belong to a copy of each block, and can be safely stored for
+            later use. If False, the rows are references into the internal buffer, which avoids copying each block.
+            In this case, a row is only valid until the next row is requested, and no reference to it may be kept.
+        :param out: An optional array with at least block_size rows, which is reused to hold the copy of each block.
+            This avoids allocating a new copy for every block. The rows are references into this array, so a row is
+            only valid until the next block is copied into it.
         :return: A generator that iterates over the rows in the dataset.
         """
-        q = self.get_queue(path=path, n_procs=n_procs, read_ahead=read_ahead, cyclic=cyclic, block_size=block_size, ordered=ordered, field=field, remainder=remainder)
+        if copy and out is None:
+            batch_gen = self.get_batch_generator(path=path, n_procs=n_procs, read_ahead=read_ahead, cyclic=cyclic, block_size=block_size, ordered=ordered, field=field, remainder=remainder, align_chunks=align_chunks, memory_budget=memory_budget, dtype=dtype, affinity=affinity)
+            try:
+                for batch in batch_gen:
+                    for row in batch:
+                        yield row
+            finally:
+                batch_gen.close()
+            return
+
+        q = self.get_queue(path=path, n_procs=n_procs, read_ahead=read_ahead, cyclic=cyclic, block_size=block_size, ordered=ordered, field=field, remainder=remainder, align_chunks=align_chunks, memory_budget=memory_budget, dtype=dtype, affinity=affinity)
 
         try:
             # This generator just implements a standard access pattern for the direct access queue.
             for guard in q.iter():
-                with guard as batch:
-                    batch_copy = batch.copy()
+                if out is None:
+                    # The guard is held until every row in the block has been consumed.
+                    with guard as batch:
+                        for row in batch:
+                            yield row
+                    # Drop the last reference into the internal buffer.
+                    row = None
+                else:
+                    with guard as batch:
+                        batch_copy = out[:batch.shape[0]]
+                        batch_copy[...] = batch
 
-                for row in batch_copy:
-                    yield row
+                    for row in batch_copy:
+                        yield row
 
         finally:
             q.close()
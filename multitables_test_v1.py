@@ -10,6 +10,7 @@ import os
 import shutil
 import tables
 import threading
+import warnings
 
 import multitables
 
@@ -118,6 +119,105 @@ class MultiTablesTest(unittest.TestCase):
 
         table_gen.close()
 
+    def test_generator_field(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        col_gen = reader.get_generator(path=self.test_table_path, field='col_B')
+
+        assert_items_equal(self,
+                           list(col_gen),
+                           list(self.test_table_ary['col_B']),
+                           key=lambda x: x[0, 0])
+
+        col_gen.close()
+
+    def test_generator_dtype(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        ary_gen = reader.get_generator(path=self.test_array_path, dtype=np.float32)
+
+        rows = list(ary_gen)
+        self.assertEqual(rows[0].dtype, np.float32)
+        assert_items_equal(self,
+                           rows,
+                           list(self.test_array.astype(np.float32)),
+                           key=lambda x: x[0, 0])
+
+        ary_gen.close()
+
+        ary_gen = reader.get_generator(path=self.test_array_path, cyclic=True, block_size=300, ordered=True, dtype=np.float32)
+
+        for row, expected in zip(ary_gen, list(self.test_array)*2):
+            np.testing.assert_array_equal(row, expected.astype(np.float32))
+
+        ary_gen.close()
+
+    def test_generator_nocopy(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        ary_gen = reader.get_generator(path=self.test_array_path, copy=False)
+
+        assert_items_equal(self,
+                           [row.copy() for row in ary_gen],
+                           list(self.test_array),
+                           key=lambda x: x[0, 0])
+
+        ary_gen.close()
+
+    def test_generator_out(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        block_size = 16
+        out = np.empty((block_size,) + self.test_array.shape[1:], dtype=self.test_array.dtype)
+        ary_gen = reader.get_generator(path=self.test_array_path, block_size=block_size, out=out)
+
+        assert_items_equal(self,
+                           [row.copy() for row in ary_gen],
+                           list(self.test_array),
+                           key=lambda x: x[0, 0])
+
+        ary_gen.close()
+
+    def test_batch_generator(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        batch_gen = reader.get_batch_generator(path=self.test_array_path, block_size=self.test_array.shape[0]//4 + 1)
+
+        batches = list(batch_gen)
+        # Only the remainder block may be shorter, but the blocks are not returned in order.
+        self.assertEqual(sum(batch.shape[0] != self.test_array.shape[0]//4 + 1 for batch in batches), 1)
+
+        assert_items_equal(self,
+                           list(np.concatenate(batches)),
+                           list(self.test_array),
+                           key=lambda x: x[0, 0])
+
+        batch_gen.close()
+
+    def test_memory_budget(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        block_size = self.test_array.shape[0]//4
+        block_nbytes = self.test_array[:block_size].nbytes
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            q = reader.get_queue(path=self.test_array_path, n_procs=2, block_size=block_size,
+                                 memory_budget=3*block_nbytes)
+            self.assertTrue(any(issubclass(x.category, RuntimeWarning) for x in w))
+
+        result = []
+        for guard in q.iter():
+            with guard as block:
+                result.append(block.copy())
+
+        assert_items_equal(self,
+                           list(np.concatenate(result)),
+                           list(self.test_array[:4*block_size]),
+                           key=lambda x: x[0, 0])
+
+        q.close()
+
     def test_ordered(self):
         reader = multitables.Streamer(filename=self.test_filename)
 
@@ -139,6 +239,18 @@ class MultiTablesTest(unittest.TestCase):
 
         table_gen.close()
 
+    def test_ordered_single_proc(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        ary_gen = reader.get_generator(path=self.test_array_path, n_procs=1, block_size=16, ordered=True)
+
+        assert_items_equal(self,
+                           list(ary_gen),
+                           list(self.test_array),
+                           key=None)
+
+        ary_gen.close()
+
     def test_direct(self):
         block_size = None
         reader = multitables.Streamer(filename=self.test_filename)
@@ -174,6 +286,96 @@ class MultiTablesTest(unittest.TestCase):
                            key=lambda x: x[0, 0, 0])
         queue.close()
 
+    def test_copy_async(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        queue = reader.get_queue(path=self.test_array_path, block_size=16)
+
+        futures = []
+        while True:
+            future = queue.get_copy_async()
+            if future is multitables.QueueClosed:
+                break
+            futures.append(future)
+        result = [future.result() for future in futures]
+        result.append(reader.get_remainder(path=self.test_array_path, block_size=queue.block_size))
+        assert_items_equal(self,
+                           result,
+                           get_batches(self.test_array, queue.block_size),
+                           key=lambda x: x[0, 0, 0])
+        queue.close()
+
+    def test_queue_multi(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        paths = [self.test_array_path, self.test_table_path]
+        queue = reader.get_queue_multi(paths=paths, block_size=16, remainder=True)
+
+        results = {path: [] for path in paths}
+        for path, guard in queue.iter():
+            with guard as batch:
+                results[path].append(batch.copy())
+        queue.close()
+
+        assert_items_equal(self,
+                           list(np.concatenate(results[self.test_array_path])),
+                           list(self.test_array),
+                           key=lambda x: x[0, 0])
+        assert_items_equal(self,
+                           list(np.concatenate(results[self.test_table_path])),
+                           list(self.test_table_ary),
+                           key=lambda x: x['col_B'][0][0])
+
+        queue = reader.get_queue_multi(paths=paths, block_size=16, ordered=True)
+
+        result_paths = []
+        result = []
+        for path, guard in queue.iter():
+            result_paths.append(path)
+            with guard as batch:
+                if path == self.test_array_path:
+                    result.append(batch.copy())
+        queue.close()
+
+        self.assertEqual(result_paths, sorted(result_paths, key=paths.index))
+        np.testing.assert_array_equal(np.concatenate(result), self.test_array[:16*(self.test_array.shape[0]//16)])
+
+    def test_align_chunks(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        with tables.open_file(self.test_filename, 'r') as h5_file:
+            chunk_length = h5_file.get_node(self.test_table_path).chunkshape[0]
+
+        queue = reader.get_queue(path=self.test_table_path, block_size=chunk_length + 1, align_chunks=True)
+        self.assertEqual(queue.block_size, 2*chunk_length)
+
+        result = []
+        for guard in queue.iter():
+            with guard as batch:
+                result.append(batch.copy())
+        result.append(reader.get_remainder(path=self.test_table_path, block_size=queue.block_size))
+        assert_items_equal(self,
+                           result,
+                           get_batches(self.test_table_ary, queue.block_size),
+                           key=lambda x: x['col_B'][0, 0, 0])
+        queue.close()
+
+    def test_default_block_size(self):
+        reader = multitables.Streamer(filename=self.test_filename)
+
+        with tables.open_file(self.test_filename, 'r') as h5_file:
+            table = h5_file.get_node(self.test_table_path)
+            chunk_length = table.chunkshape[0]
+            row_nbytes = table[0].nbytes
+
+        queue = reader.get_queue(path=self.test_table_path)
+        if queue.block_size < self.test_table_ary.shape[0]:
+            # Whole chunks are grouped into a block of at least 128KB.
+            self.assertEqual(queue.block_size % chunk_length, 0)
+            self.assertGreaterEqual(queue.block_size*row_nbytes, 128*2**10)
+            self.assertLess((queue.block_size - chunk_length)*row_nbytes, 128*2**10)
+        queue.close()
+
     def test_cycle(self):
         block_size = 45
         num_cycles = lcm(block_size, len(self.test_array))//len(self.test_array)
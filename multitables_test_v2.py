@@ -225,6 +225,104 @@ class MultiTablesTestV2(unittest.TestCase):
 
         reader.close(wait=True)
 
+    def test_request_pool_keep(self):
+        reqs = multitables.RequestPool()
+        sentinel = object()
+        reqs.add(1)
+        reqs.add(sentinel)
+
+        self.assertEqual(reqs.next(keep=sentinel), 1)
+        for _ in range(3):
+            self.assertIs(reqs.next(keep=sentinel), sentinel)
+        self.assertIs(reqs.next(), sentinel)
+
+    def test_repeat_request(self):
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
+
+        test_array = reader.get_dataset(path=self.test_array_path)
+        array_stage = test_array.create_stage(10)
+
+        req = test_array[:][5:15]
+        for _ in range(3):
+            np.testing.assert_array_equal(reader.request(req, array_stage).get(), self.test_array[5:15])
+
+        # Indexing a requested operation further changes what is read.
+        req = req[:, 2]
+        np.testing.assert_array_equal(reader.request(req, array_stage).get(), self.test_array[5:15, 2])
+
+        reader.close(wait=True)
+
+    def test_request_many(self):
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
+
+        test_array = reader.get_dataset(path=self.test_array_path)
+        N_reqs = 100
+        stage_pool = test_array.create_stage_pool(1, N_reqs)
+
+        reqs = reader.request_many([test_array[:][i:i+1] for i in range(N_reqs)], [stage_pool]*N_reqs)
+        self.assertEqual(len(reqs), N_reqs)
+        for i, req in enumerate(reqs):
+            np.testing.assert_array_equal(req.get(), self.test_array[i:i+1])
+
+        reader.close(wait=True)
+
+    def test_request_many_small_pool(self):
+        results = {}
+        done_event = threading.Event()
+        def notify(req):
+            # Fetching the result releases its stage back to the pool, so the remaining requests can proceed.
+            if req is not multitables.QueueClosed:
+                results[req] = req.get()
+                if len(results) == N_reqs:
+                    done_event.set()
+
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS, notify=notify)
+
+        test_array = reader.get_dataset(path=self.test_array_path)
+        N_reqs = 10
+        stage_pool = test_array.create_stage_pool(1, 2)
+
+        reqs = reader.request_many([test_array[:][i:i+1] for i in range(N_reqs)], [stage_pool]*N_reqs)
+        self.assertTrue(done_event.wait(10))
+        for i, req in enumerate(reqs):
+            np.testing.assert_array_equal(results[req], self.test_array[i:i+1])
+
+        reader.close(wait=True)
+
+    def test_notify_request(self):
+        chained = []
+        chained_event = threading.Event()
+        def notify(req):
+            # A request made from within the notification call-back must not block the notification spool.
+            if req is not multitables.QueueClosed and len(chained) == 0:
+                chained.append(reader.request(test_array[:][20:30], chained_stage))
+                chained_event.set()
+
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS, notify=notify)
+
+        test_array = reader.get_dataset(path=self.test_array_path)
+        array_stage = test_array.create_stage(10)
+        chained_stage = test_array.create_stage(10)
+
+        np.testing.assert_array_equal(reader.request(test_array[:][5:15], array_stage).get(), self.test_array[5:15])
+        self.assertTrue(chained_event.wait(10))
+        np.testing.assert_array_equal(chained[0].get(), self.test_array[20:30])
+
+        reader.close(wait=True)
+
+    def test_msgpack_ndarray(self):
+        from multitables.msgpack_ext import msgpack_registry
+        arrays = [
+            np.arange(20).reshape(4, 5),
+            np.arange(20).reshape(4, 5)[:, ::2],
+            np.arange(20).astype('datetime64[s]'),
+            np.arange(20).astype('timedelta64[ms]'),
+        ]
+        for ary in arrays:
+            result = msgpack_registry.unpack(msgpack_registry.pack(ary))
+            self.assertEqual(result.dtype, ary.dtype)
+            np.testing.assert_array_equal(result, ary)
+
     def test_array_getslice(self):
         reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
 
@@ -236,11 +334,83 @@ class MultiTablesTestV2(unittest.TestCase):
             #with reader.request(test_array[idx:idx+2], array_stage).get_direct() as data:
             #    np.testing.assert_array_equal(data, self.test_array[idx:idx+2])
             reader.request(test_array[idx:idx+2], array_stage).get_direct(lambda data: np.testing.assert_array_equal(data, self.test_array[idx:idx+2]))
+
+        # Slices with trailing full slices or ellipses are read straight into the stage.
+        for key in [np.s_[4:6, :], np.s_[4:6, ...], np.s_[4:6, :, :]]:
+            self.assertIsInstance(test_array[key], multitables.dataset_ops.ReadOpArray)
+            np.testing.assert_array_equal(reader.request(test_array[key], array_stage).get(), self.test_array[key])
         
         array_stage.close()
 
         reader.close(wait=True)
 
+    def test_col_access(self):
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
+
+        test_table = reader.get_dataset(path=self.test_table_path)
+        table_stage = test_table.create_stage(10)
+
+        req = test_table.col('col_C')
+        self.assertIsInstance(req, multitables.dataset_ops.ColOp)
+        np.testing.assert_array_equal(reader.request(req, table_stage).get(), self.test_table_ary['col_C'])
+
+        req = test_table['col_C']
+        self.assertIsInstance(req, multitables.dataset_ops.ColOp)
+        np.testing.assert_array_equal(reader.request(req, table_stage).get(), self.test_table_ary['col_C'])
+
+        coords = [7, 3, 3, 900, 0]
+        req = test_table['col_C'][coords]
+        self.assertIsInstance(req, multitables.dataset_ops.CoordOp)
+        np.testing.assert_array_equal(reader.request(req, table_stage).get(), self.test_table_ary['col_C'][coords])
+
+        table_stage.close()
+        reader.close(wait=True)
+
+    def test_astype(self):
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
+
+        test_array = reader.get_dataset(path=self.test_array_path)
+        test_table = reader.get_dataset(path=self.test_table_path)
+        array_stage = test_array.create_stage(10, dtype=np.float32)
+        table_stage = test_table.create_stage(10)
+
+        result = reader.request(test_array[:10].astype(np.float32), array_stage).get()
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_array_equal(result, self.test_array[:10].astype(np.float32))
+
+        result = reader.request(test_array[3].astype(np.float32), array_stage).get()
+        np.testing.assert_array_equal(result, self.test_array[3].astype(np.float32))
+
+        result = reader.request(test_table.col('col_A')[:10].astype(np.int8), table_stage).get()
+        self.assertEqual(result.dtype, np.int8)
+        np.testing.assert_array_equal(result, self.test_table_ary['col_A'][:10].astype(np.int8))
+
+        # Indexing the wrapped operation after a request changes what the cast operation reads.
+        op = test_array[:][:10]
+        cast_op = op.astype(np.float32)
+        result = reader.request(cast_op, array_stage).get()
+        np.testing.assert_array_equal(result, self.test_array[:10].astype(np.float32))
+        op[:, 0]
+        result = reader.request(cast_op, array_stage).get()
+        np.testing.assert_array_equal(result, self.test_array[:10, 0].astype(np.float32))
+
+        reader.close(wait=True)
+
+    def test_mutable_key(self):
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
+
+        test_table = reader.get_dataset(path=self.test_table_path)
+        table_stage = test_table.create_stage(3)
+
+        # Changing the coordinates after a request changes what the operation reads.
+        coords = np.array([1, 2, 3])
+        op = test_table['col_C'][coords]
+        np.testing.assert_array_equal(reader.request(op, table_stage).get(), self.test_table_ary['col_C'][[1, 2, 3]])
+        coords[:] = [4, 5, 6]
+        np.testing.assert_array_equal(reader.request(op, table_stage).get(), self.test_table_ary['col_C'][[4, 5, 6]])
+
+        reader.close(wait=True)
+
     def test_indexing(self):
         reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
 
@@ -266,15 +436,25 @@ class MultiTablesTestV2(unittest.TestCase):
             np.testing.assert_array_equal(data, self.test_table_ary['col_A'][30:35])
 
         req = test_table.col('col_A')[30:35,...,:100]
-        self.assertIsInstance(req, multitables.dataset_ops.ColOp)
+        self.assertIsInstance(req, multitables.dataset_ops.ReadOpTable)
         with reader.request(req, table_stage).get_unsafe() as data:
             np.testing.assert_array_equal(data, self.test_table_ary['col_A'][30:35,...,:100])
 
         req = test_table['col_A'][30:35,np.arange(500) > 45]
-        self.assertIsInstance(req, multitables.dataset_ops.ColOp)
+        self.assertIsInstance(req, multitables.dataset_ops.ReadOpTable)
         with reader.request(req, table_stage).get_unsafe() as data:
             np.testing.assert_array_equal(data, self.test_table_ary[...]['col_A'][30:35,np.arange(500) > 45])
 
+        req = test_table['col_A'][3,:,5:10]
+        self.assertIsInstance(req, multitables.dataset_ops.ReadScalarOpTable)
+        with reader.request(req, table_stage).get_unsafe() as data:
+            np.testing.assert_array_equal(data, self.test_table_ary['col_A'][3,:,5:10])
+
+        req = test_table['col_A'][3,:,[1,2]]
+        with reader.request(req, table_stage).get_unsafe() as data:
+            self.assertEqual(data.shape, (2, test_table_col_A_shape[0]))
+            np.testing.assert_array_equal(data, self.test_table_ary['col_A'][3,:,[1,2]])
+
         req = test_table[:]['col_A'][30:35,np.arange(500) > 45]
         self.assertIsInstance(req, multitables.dataset_ops.ReadOpTable)
         with reader.request(req, table_stage).get_unsafe() as data:
@@ -290,6 +470,12 @@ class MultiTablesTestV2(unittest.TestCase):
         with reader.request(req, table_stage).get_unsafe() as data:
             np.testing.assert_array_equal(data, self.test_table_ary['col_A'][[1,2,3]])
 
+        req = test_table['col_A'][[1,5,2,8]][1:3, :10]
+        self.assertIsInstance(req, multitables.dataset_ops.CoordOp)
+        self.assertEqual(list(req._coords), [5,2])
+        with reader.request(req, table_stage).get_unsafe() as data:
+            np.testing.assert_array_equal(data, self.test_table_ary['col_A'][[1,5,2,8]][1:3, :10])
+
         req = test_table[[1,2,3]]['col_A']
         self.assertIsInstance(req, multitables.dataset_ops.CoordOp)
         self.assertEqual(req._col, 'col_A')
@@ -343,6 +529,12 @@ class MultiTablesTestV2(unittest.TestCase):
             np.testing.assert_array_equal(data['col_C'], table_subset[table_subset['col_C'] > 0.1]['col_C'])
             np.testing.assert_array_equal(data, table_subset[table_subset['col_C'] > 0.1])
 
+        req = test_table.where('col_C > x', condvars={'x':0.1}, start=300, stop=400)['col_B']
+        self.assertIsInstance(req, multitables.dataset_ops.WhereOp)
+        self.assertEqual(req._col, 'col_B')
+        with reader.request(req, table_stage_big).get_unsafe() as data:
+            np.testing.assert_array_equal(data, table_subset[table_subset['col_C'] > 0.1]['col_B'])
+
         req = test_table.read_sorted('col_C', checkCSI=True, start=200, stop=300)
         self.assertIsInstance(req, multitables.dataset_ops.SortOp)
         table_subset = self.test_table_ary.copy()
@@ -417,6 +609,42 @@ class MultiTablesTestV2(unittest.TestCase):
         array_stage.close()
         reader.close(wait=True)
 
+    def test_stage_alignment(self):
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
+
+        test_array = reader.get_dataset(path=self.test_array_path)
+        array_stage = test_array.create_stage(10)
+
+        with reader.request(test_array[:10], array_stage).get_unsafe() as data:
+            self.assertTrue(data.flags.aligned)
+        data = None
+
+        reader.close(wait=True)
+
+    def test_prefault_stage(self):
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
+
+        test_byte_array = reader.get_dataset(path=self.test_byte_ary_path)
+        array_stage = test_byte_array.create_stage(1000*1000, prefault=True)
+
+        test = reader.request(test_byte_array[:], array_stage).get()
+        np.testing.assert_array_equal(test, self.test_byte_ary)
+
+        array_stage.close()
+        reader.close(wait=True)
+
+    @unittest.skipIf(not hasattr(os, 'sched_setaffinity'), "CPU affinity is not supported on this platform.")
+    def test_affinity(self):
+        cpus = sorted(os.sched_getaffinity(0))[:1]
+        reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS, affinity=cpus)
+
+        test_array = reader.get_dataset(path=self.test_array_path)
+        array_stage = test_array.create_stage(10)
+
+        np.testing.assert_array_equal(reader.request(test_array[:10], array_stage).get(), self.test_array[:10])
+
+        reader.close(wait=True)
+
     def test_del(self):
         reader = multitables.Reader(filename=self.test_filename, n_procs=N_PROCS)
 